@@ -5,18 +5,54 @@ from __future__ import print_function
 import numpy as np
 import tensorflow as tf
 from numbers import Number
-import pickle
 
 import time
 import datetime
 import ray
 import ray.experimental.tf_utils
 
+from checkpoint_manager import CheckpointManager
 import core
 from core import get_vars
 from core import actor_critic
 
 
+class FlatWeightsOps(object):
+    """
+    Graph ops moving the flat weight vector of a WeightLayout in or out of a session in one sess.run:
+    a placeholder fed assign that splits it over the variables, and a concat of them. Built on first
+    use for each layout. Variables of the layout missing from the graph are skipped by assign.
+    """
+
+    def __init__(self, sess, variables):
+        self.sess = sess
+        # TensorFlowVariables.variables, name -> tf.Variable
+        self.variables = variables
+        self.ops = {}
+
+    def assign(self, layout, flat):
+        flat_ph, assign_op, _ = self._get_ops(layout)
+        self.sess.run(assign_op, feed_dict={flat_ph: flat})
+
+    def export(self, layout):
+        return self.sess.run(self._get_ops(layout)[2])
+
+    def _get_ops(self, layout):
+        key = tuple(layout.keys)
+        if key not in self.ops:
+            with self.sess.graph.as_default(), tf.name_scope('flat_weights'):
+                flat_ph = tf.placeholder(tf.float32, shape=(layout.size,))
+                parts = tf.split(flat_ph, np.diff(layout.offsets).tolist())
+                assign_op = tf.group([tf.assign(self.variables[name], tf.reshape(part, shape))
+                                      for name, shape, part in zip(layout.keys, layout.shapes, parts)
+                                      if name in self.variables])
+                export_op = None
+                if all(name in self.variables for name in layout.keys):
+                    export_op = tf.concat([tf.reshape(self.variables[name], [-1]) for name in layout.keys], axis=0)
+            self.ops[key] = flat_ph, assign_op, export_op
+        return self.ops[key]
+
+
 class Learner(object):
     def __init__(self, opt, job):
         self.opt = opt
@@ -83,9 +119,13 @@ class Learner(object):
                            opt.gamma * (1 - self.d_ph[:, step_i]) * (-alpha_v * self.logp_pi_ph[:, step_i] + q_backup)
             ####
 
+            # importance sampling weights, only fed with prioritized replay
+            self.is_weights_ph = tf.placeholder_with_default(tf.ones_like(q1), shape=(None,))
+            self.td_error = 0.5 * (tf.abs(q_backup - q1) + tf.abs(q_backup - q2))
+
             # Soft actor-critic losses
-            q1_loss = 0.5 * tf.reduce_mean((q_backup - q1) ** 2)
-            q2_loss = 0.5 * tf.reduce_mean((q_backup - q2) ** 2)
+            q1_loss = 0.5 * tf.reduce_mean(self.is_weights_ph * (q_backup - q1) ** 2)
+            q2_loss = 0.5 * tf.reduce_mean(self.is_weights_ph * (q_backup - q2) ** 2)
             self.value_loss = q1_loss + q2_loss
 
             value_optimizer = tf.train.AdamOptimizer(learning_rate=opt.lr)
@@ -137,16 +177,24 @@ class Learner(object):
 
             self.variables = ray.experimental.tf_utils.TensorFlowVariables(
                 self.value_loss, self.sess)
+            self.main_keys = [key for key in self.variables.variables.keys() if "main" in key]
+            self.flat_ops = FlatWeightsOps(self.sess, self.variables.variables)
 
     def set_weights(self, variable_names, weights):
         self.variables.set_weights(dict(zip(variable_names, weights)))
         self.sess.run(self.target_init)
 
     def get_weights(self):
-        weights = self.variables.get_weights()
-        keys = [key for key in list(weights.keys()) if "main" in key]
-        values = [weights[key] for key in keys]
-        return keys, values
+        values = self.sess.run([self.variables.variables[key] for key in self.main_keys])
+        return self.main_keys, values
+
+    def set_flat_weights(self, layout, flat):
+        # flat weight vector from the ParameterServer, see WeightLayout
+        self.flat_ops.assign(layout, flat)
+        self.sess.run(self.target_init)
+
+    def get_flat_weights(self, layout):
+        return self.flat_ops.export(layout)
 
     def get_logp_pi(self, x):
         logp_pi_s = []
@@ -164,8 +212,10 @@ class Learner(object):
                      self.r_ph: batch['rews'],
                      self.d_ph: batch['done'],
                      }
+        if 'weights' in batch:
+            feed_dict[self.is_weights_ph] = batch['weights']
 
-        outs = self.sess.run(self.step_ops, feed_dict)
+        outs, td_error = self.sess.run([self.step_ops, self.td_error], feed_dict)
         if cnt % 500 == 0:
             summary_str = self.sess.run(self.train_ops, feed_dict={
                 self.train_vars[0]: outs[0],
@@ -178,6 +228,7 @@ class Learner(object):
 
             self.writer.add_summary(summary_str, cnt)
             self.writer.flush()
+        return td_error
 
     def compute_gradients(self, x, y):
         pass
@@ -217,7 +268,7 @@ class Actor(object):
             np.random.seed(opt.seed)
 
             # Inputs to computation graph
-            self.x_ph, self.a_ph, self.x2_ph, = core.placeholders(opt.obs_shape, opt.act_shape, opt.obs_shape)
+            self.x_ph = core.placeholder(opt.obs_shape)
 
             # ------
             if opt.alpha == 'auto':
@@ -227,17 +278,18 @@ class Actor(object):
                 alpha_v = opt.alpha
             # ------
 
-            # Main outputs from computation graph
+            # Main outputs from computation graph, the policy alone: acting needs no critic or x2 branch
             with tf.variable_scope('main'):
-                self.mu, self.pi, logp_pi, logp_pi2, q1, q2, q1_pi, q2_pi, q1_mu, q2_mu \
-                    = actor_critic(self.x_ph, self.x2_ph, self.a_ph, alpha_v,
-                                   hidden_sizes=opt.hidden_size,
-                                   action_space=opt.act_space,
-                                   phase=False, use_bn=opt.use_bn, coefficent_regularizer=opt.c_regularizer,
-                                   model=opt.model)
+                self.mu, self.pi = core.actor(self.x_ph, alpha_v,
+                                              hidden_sizes=opt.hidden_size,
+                                              action_space=opt.act_space,
+                                              phase=False, use_bn=opt.use_bn,
+                                              coefficent_regularizer=opt.c_regularizer,
+                                              model=opt.model)
 
-            # Set up summary Ops
-            self.test_ops, self.test_vars = self.build_summaries()
+            if job == "main":
+                # Set up summary Ops
+                self.test_ops, self.test_vars = self.build_summaries()
 
             self.sess = tf.Session(
                 config=tf.ConfigProto(
@@ -258,24 +310,38 @@ class Actor(object):
             self.variables = ray.experimental.tf_utils.TensorFlowVariables(
                 self.pi, self.sess, input_variables=variables_bn)
 
+            # get_actions fast path, without a feed_dict or fetch list to build per call
+            self.act_fns = {True: self.sess.make_callable(self.mu, [self.x_ph]),
+                            False: self.sess.make_callable(self.pi, [self.x_ph])}
+            self.main_keys = [key for key in self.variables.variables.keys() if "main" in key]
+            self.flat_ops = FlatWeightsOps(self.sess, self.variables.variables)
+
     def set_weights(self, variable_names, weights):
         self.variables.set_weights(dict(zip(variable_names, weights)))
 
     def get_weights(self):
-        weights = self.variables.get_weights()
-        keys = [key for key in list(weights.keys()) if "main" in key]
-        values = [weights[key] for key in keys]
-        return keys, values
+        values = self.sess.run([self.variables.variables[key] for key in self.main_keys])
+        return self.main_keys, values
+
+    def set_flat_weights(self, layout, flat):
+        # flat weight vector from the ParameterServer, see WeightLayout
+        self.flat_ops.assign(layout, flat)
 
     def get_action(self, o, deterministic):
-        act_op = self.mu if deterministic else self.pi
-        return self.sess.run(act_op, feed_dict={self.x_ph: np.expand_dims(o, axis=0)})[0]
+        return self.get_actions(np.expand_dims(o, axis=0), deterministic)[0]
+
+    def get_actions(self, o, deterministic):
+        # a batch of observations, e.g. one from each env of a vectorized rollout worker
+        return self.act_fns[deterministic](o)
 
     def test(self, ps, replay_buffer, opt, test_env, n=50):
 
-        keys, _ = self.get_weights()
+        # version vector of the weights under test
+        weights_versions = [-1] * len(ps.shards)
         save_times = 0
         checkpoint_time = 0
+        checkpoints = CheckpointManager(opt.save_dir + "/checkpoint", opt.keep_last_checkpoints,
+                                        opt.keep_best_checkpoints)
         max_ret = -10000
         start_time = time.time()
 
@@ -288,10 +354,10 @@ class Actor(object):
 
         while True:
             # weights_all for save it to local
-            weights_all = ray.get(ps.get_weights.remote())
-            weights = [weights_all[key] for key in keys]
-
-            self.set_weights(keys, weights)
+            weights_versions, flat = ps.pull_if_newer(weights_versions)
+            if flat is not None:
+                self.set_flat_weights(ps.layout, flat)
+                weights_all = ps.layout.unflatten(flat)
             # TODO
 
             rew = []
@@ -324,25 +390,22 @@ class Actor(object):
             print("----------------------------------")
 
             if last_learner_steps // opt.save_interval > save_times:
-                with open(opt.save_dir + "/" + str(last_learner_steps / 1e6) + "M_" + str(
-                        test_reward) + "_weights.pickle", "wb") as pickle_out:
-                    pickle.dump(weights_all, pickle_out)
-                    print("****** Weights saved by time! ******")
+                checkpoints.save(weights_all, last_learner_steps, test_reward)
+                print("****** Weights saved by time! ******")
                 save_times = last_learner_steps // opt.save_interval
-
-            if test_reward >= max_ret:
-                with open(opt.save_dir + "/" + str(last_learner_steps / 1e6) + "M_" + str(
-                        test_reward) + "Max_weights.pickle", "wb") as pickle_out:
-                    pickle.dump(weights_all, pickle_out)
-                    print("****** Weights saved by maxret! ******")
-                max_ret = test_reward
+            elif test_reward >= max_ret:
+                checkpoints.save(weights_all, last_learner_steps, test_reward)
+                print("****** Weights saved by maxret! ******")
+            max_ret = max(max_ret, test_reward)
 
             # save everything every 6 hours
             if total_time // opt.checkpoint_freq > checkpoint_time:
                 save_start_time = time.time()
                 buffer_save_op = [replay_buffer[i].save.remote() for i in range(opt.num_buffers)]
-                ps_save_op = ps.save_weights.remote()
-                ray.wait(buffer_save_op + [ps_save_op], num_returns=opt.num_buffers+1)
+                # the shards hold parts of the weights, the checkpoint is taken here from one consistent pull
+                checkpoints.save(ps.layout.unflatten(ps.pull()), learner_steps)
+                ray.wait(buffer_save_op, num_returns=opt.num_buffers)
+                checkpoints.wait()
                 print("total time for saving :", time.time()-save_start_time)
                 checkpoint_time = total_time // opt.checkpoint_freq
 
@@ -0,0 +1,122 @@
+import json
+import os
+import pickle
+import queue
+import threading
+import traceback
+
+import numpy as np
+
+MANIFEST = "weights_manifest.json"
+
+
+class CheckpointManager(object):
+    """
+    Weight checkpoints of a run, written to one directory in the background.
+
+    save() copies the weights and returns at once, a thread pickles the copy to a temporary file and
+    renames it into place, so a crash never leaves a partial checkpoint behind. The manifest lists the
+    checkpoints with their learner step and test reward, and only the keep_last newest ones and the
+    keep_best best rewarded ones are kept on disk. latest_checkpoint() finds the newest one again.
+    """
+
+    def __init__(self, directory, keep_last, keep_best):
+        self.directory = directory
+        self.keep_last, self.keep_best = keep_last, keep_best
+        # the checkpoints of a recovered run stay under the same retention
+        self.entries = read_manifest(directory)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, weights, step, reward=None):
+        # a copy, the caller's arrays may be views of the object store or change under the writer
+        snapshot = {key: np.array(value) for key, value in weights.items()}
+        self.queue.put((snapshot, step, reward))
+
+    def wait(self):
+        # block until every save() so far is on disk
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            weights, step, reward = self.queue.get()
+            try:
+                self._write(weights, step, reward)
+            except Exception:
+                # a failed write must not stop the thread, wait() would never return again
+                print("****** Weights of step", step, "not saved! ******")
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def _write(self, weights, step, reward):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        name = str(step / 1e6) + "M_" + ("" if reward is None else str(reward) + "_") + "weights.pickle"
+        with atomic_open(os.path.join(self.directory, name)) as pickle_out:
+            pickle.dump(weights, pickle_out)
+
+        self.entries = [entry for entry in self.entries if entry["file"] != name]
+        self.entries.append(dict(file=name, step=step, reward=reward))
+        by_step = sorted(self.entries, key=lambda entry: entry["step"])
+        rewarded = sorted([entry for entry in self.entries if entry["reward"] is not None],
+                          key=lambda entry: entry["reward"])
+        keep = set(entry["file"] for entry in by_step[max(len(by_step) - self.keep_last, 0):])
+        keep.update(entry["file"] for entry in rewarded[max(len(rewarded) - self.keep_best, 0):])
+        removed = [entry for entry in self.entries if entry["file"] not in keep]
+        self.entries = [entry for entry in self.entries if entry["file"] in keep]
+
+        # the manifest never lists a deleted checkpoint
+        with atomic_open(os.path.join(self.directory, MANIFEST), "w") as f:
+            json.dump(self.entries, f, indent=4)
+        for entry in removed:
+            try:
+                os.remove(os.path.join(self.directory, entry["file"]))
+            except OSError:
+                pass
+
+
+class atomic_open(object):
+    """
+    open() for writing into a temporary file that replaces path on a clean exit of the with block.
+    """
+
+    def __init__(self, path, mode="wb"):
+        self.path, self.tmp_path = path, path + ".tmp"
+        self.f = open(self.tmp_path, mode)
+
+    def __enter__(self):
+        return self.f
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            # on disk before the rename, or a crash can leave path renamed but empty
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        self.f.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return []
+
+
+def latest_checkpoint(directory):
+    """
+    Path of the newest weight checkpoint in directory: the CheckpointManager one of the highest learner
+    step, or the checkpoint_weights.pickle of runs from before the manifest. None if there is neither.
+    """
+    entries = read_manifest(directory)
+    if entries:
+        return os.path.join(directory, max(entries, key=lambda entry: entry["step"])["file"])
+    legacy = os.path.join(directory, "checkpoint_weights.pickle")
+    return legacy if os.path.exists(legacy) else None
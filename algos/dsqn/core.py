@@ -181,6 +181,27 @@ Actor-Critics
 """
 
 
+def actor(x, alpha, hidden_sizes, activation=tf.nn.relu,
+          output_activation=None,
+          use_bn=False, phase=True, coefficent_regularizer=0.0,
+          policy=softmax_policy, action_space=None, model="mlp"):
+    # the policy part of actor_critic alone (Q1 and the softmax over it), with the same variable names,
+    # for inference-only graphs
+    if x.shape[1] == 128:  # for Breakout-ram-v4
+        x = (x - 128.0) / 128.0  # x: shape(?,128)
+
+    act_dim = action_space.n
+    if model == "mlp":
+        vf_model = lambda x: mlp(x, list(hidden_sizes) + [act_dim], activation, output_activation, use_bn=use_bn,
+                                 phase=phase, coefficent_regularizer=coefficent_regularizer)  # return: shape(?,4)
+    else:
+        vf_model = lambda x: nature_cnn(x)
+
+    q1_tp = tf.make_template('q1', vf_model, create_scope_now_=True)
+    mu, pi, _ = policy(alpha, q1_tp(x), act_dim)
+    return mu, pi
+
+
 def actor_critic(x, x2, a, alpha, hidden_sizes, activation=tf.nn.relu,
                  output_activation=None,
                  use_bn=False, phase=True, coefficent_regularizer=0.0,
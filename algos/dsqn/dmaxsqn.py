@@ -3,19 +3,31 @@ import tensorflow as tf
 import time
 import ray
 import gym
-from collections import deque
 
 from hyperparams import HyperParameters, Wrapper
 from actor_learner import Actor, Learner
+from flat_weights import WeightLayout
+from weight_codec import WeightEncoder, transport_layout
+from sharded_ps import ParameterServerShards, partition_keys
+from checkpoint_manager import latest_checkpoint
+from weight_refresh import WeightRefresher
+from inference_server import RemotePolicy, start_inference_servers
+from numpy_policy import SoftmaxPolicy
+from env_pool import EnvPool, LocalEnvs
+from prefetcher import BatchPrefetcher
+from rate_limiter import RateLimiter
+from sum_tree import SumTree
+from image_store import ImageStore, compress_frame
+from tiered_array import TieredArray
+from shared_arrays import SharedArrays, header_field
 
 import os
 import pickle
-import multiprocessing
 import copy
+import threading
 
 import inspect
 import json
-from ray.rllib.utils.compression import pack, unpack
 
 
 flags = tf.app.flags
@@ -33,94 +45,383 @@ flags.DEFINE_bool("recover", False, "back training from last checkpoint")
 flags.DEFINE_string("checkpoint_path", "", "empty means opt.save_dir. ")
 
 
-@ray.remote(num_cpus=2)
 class ReplayBuffer:
     """
     A simple FIFO experience replay buffer for SQN_N_STEP agents.
+
+    Steps are stored trajectory-major, one row per observation, as segments sent by the rollout workers.
+    buffer_a/r/d[i] hold the transition taken from buffer_o[i], and buffer_valid[i] marks the rows where
+    an n-step window of Ln transitions of the same episode starts. Windows are gathered at sample time
+    instead of storing every observation Ln + 1 times. Image observations (cnn) live in an ImageStore.
+    With opt.tiered_buffer the columns are TieredArrays, the newest rows in RAM and the rest on disk.
+
+    With opt.shared_buffer the columns and cursors live in POSIX shared memory. The RemoteReplayBuffer
+    actor creates them and serves get_counts/save/load, while rollout and learner processes build a
+    ReplayBuffer(opt, buffer_index, attach=True) and call store_many/sample_batch on it directly.
     """
 
-    def __init__(self, opt, buffer_index):
+    # cursors, kept in self.header so that they can be shared with the other processes
+    ptr, size, written, actor_steps, learner_steps = [header_field(i) for i in range(5)]
+
+    def __init__(self, opt, buffer_index, attach=False):
         self.opt = opt
         self.buffer_index = buffer_index
-        if opt.model == "cnn":
-            self.buffer_o = np.array([['0' * 2000] * (opt.Ln + 1)] * opt.buffer_size, dtype=np.str)
+        if opt.shared_buffer:
+            assert opt.model == "mlp" and not opt.tiered_buffer and not opt.prioritized_replay, \
+                "shared memory buffers only hold mlp observations, without tiers or priorities"
+            self.shared = SharedArrays(opt.shared_buffer_name + '_' + str(buffer_index), create=not attach)
+            self.buffer_o = self.shared.array('o', (opt.buffer_size,) + opt.obs_shape, np.float32)
+            self.buffer_a = self.shared.array('a', (opt.buffer_size,) + opt.act_shape, np.float32)
+            self.buffer_r = self.shared.array('r', (opt.buffer_size,), np.float32)
+            self.buffer_d = self.shared.array('d', (opt.buffer_size,), np.float32)
+            self.buffer_valid = self.shared.array('valid', (opt.buffer_size,), bool)
+            self.header = self.shared.array('header', (5,), np.int64)
+            self.lock = self.shared.lock
         else:
-            self.buffer_o = np.zeros((opt.buffer_size, opt.Ln + 1) + opt.obs_shape, dtype=np.float32)
-        self.buffer_a = np.zeros((opt.buffer_size, opt.Ln) + opt.act_shape, dtype=np.float32)
-        self.buffer_r = np.zeros((opt.buffer_size, opt.Ln), dtype=np.float32)
-        self.buffer_d = np.zeros((opt.buffer_size, opt.Ln), dtype=np.float32)
-        self.ptr, self.size, self.max_size = 0, 0, opt.buffer_size
-        self.actor_steps, self.learner_steps = 0, 0
-
-    def store(self, o_queue, a_r_d_queue, worker_index):
-
-        obs, = np.stack(o_queue, axis=1)
+            self._init_local_storage(opt)
+        self.max_size = opt.buffer_size
+        # rows written at the last checkpoint
+        self.checkpointed = 0
+        self.save_thread = None
 
+    def _init_local_storage(self, opt):
         if opt.model == "cnn":
-            self.buffer_o[self.ptr] = obs
+            self.image_store = ImageStore(opt.buffer_size, opt.obs_shape, compressed=opt.compress_frames,
+                                          arena_bytes=opt.buffer_size * opt.compressed_frame_bytes)
+            # decoded frames of one batch
+            self.obs_out = np.empty((opt.batch_size, opt.Ln + 1) + opt.obs_shape, dtype=np.uint8)
+        elif opt.tiered_buffer:
+            assert not opt.prioritized_replay, "prioritized replay over a tiered buffer is not supported"
+            os.makedirs(opt.spill_dir, exist_ok=True)
+            self.buffer_o = self._tiered_array('o', opt.obs_shape)
         else:
-            self.buffer_o[self.ptr] = np.array(list(obs), dtype=np.float32)
-
-        a, r, d, = np.stack(a_r_d_queue, axis=1)
-        self.buffer_a[self.ptr] = np.array(list(a), dtype=np.float32)
-        self.buffer_r[self.ptr] = np.array(list(r), dtype=np.float32)
-        self.buffer_d[self.ptr] = np.array(list(d), dtype=np.float32)
+            self.buffer_o = np.zeros((opt.buffer_size,) + opt.obs_shape, dtype=np.float32)
+        if opt.tiered_buffer:
+            assert opt.model == "mlp", "tiered buffers only hold mlp observations"
+            self.buffer_a = self._tiered_array('a', opt.act_shape)
+            self.buffer_r = self._tiered_array('r', ())
+            self.buffer_d = self._tiered_array('d', ())
+        else:
+            self.buffer_a = np.zeros((opt.buffer_size,) + opt.act_shape, dtype=np.float32)
+            self.buffer_r = np.zeros(opt.buffer_size, dtype=np.float32)
+            self.buffer_d = np.zeros(opt.buffer_size, dtype=np.float32)
+        self.buffer_valid = np.zeros(opt.buffer_size, dtype=bool)
+        # ptr, size, rows written since the start (never wrapped), actor_steps, learner_steps
+        self.header = np.zeros(5, dtype=np.int64)
+        # Ray runs the actor methods one at a time, the lock only matters for shared buffers
+        self.lock = threading.Lock()
+        if opt.prioritized_replay:
+            self.sum_tree = SumTree(opt.buffer_size)
+            self.max_priority = 1.0
+            # write count of the last window written to every row, the priority of a sampled window is only
+            # updated if its row still holds it
+            self.generation = np.zeros(opt.buffer_size, dtype=np.int64)
+
+    def _tiered_array(self, name, shape):
+        return TieredArray(self.opt.spill_dir + '/buffer_' + name + '-' + str(self.buffer_index) + '.mmap',
+                           self.opt.buffer_size, self.opt.hot_buffer_size, self.opt.spill_size, shape)
 
-        self.ptr = (self.ptr + 1) % self.max_size
-        self.size = min(self.size + 1, self.max_size)
-        # TODO
-        self.actor_steps += self.opt.num_buffers
-        # self.actor_steps += self.buffer_store_len * self.action_repeat * self.opt.num_buffers
-        # self.actor_steps += opt.Ln * opt.action_repeat
+    def store(self, o_queue, a_r_d_queue, worker_index):
+        # a single n-step window is just a segment of Ln transitions
+        self.store_many([o for o, in o_queue],
+                        [a for a, _, _ in a_r_d_queue],
+                        [r for _, r, _ in a_r_d_queue],
+                        [d for _, _, d in a_r_d_queue], worker_index)
+
+    def store_many(self, obs, acts, rews, done, worker_index):
+        """
+        Store a trajectory segment of T transitions (T + 1 observations) of one episode,
+        with one slice assignment per array (two if the segment wraps around the ring).
+        """
+        with self.lock:
+            self._store_many(obs, acts, rews, done)
+
+    def _store_many(self, obs, acts, rews, done):
+        n = len(obs)
+        num_windows = n - self.opt.Ln
+        valid = np.arange(n) < num_windows
+        # the last row only holds the final observation of the segment
+        pad = [np.zeros((1,) + np.shape(acts)[1:], dtype=np.float32)]
+
+        if self.opt.model == "cnn":
+            evicted = self.image_store.write(self.ptr, obs)
+        else:
+            self._ring_write(self.buffer_o, obs)
+        self._ring_write(self.buffer_a, np.concatenate([acts] + pad))
+        self._ring_write(self.buffer_r, np.append(rews, 0))
+        self._ring_write(self.buffer_d, np.append(done, 0))
+        # overwriting the valid flags also drops the old windows starting in these rows
+        self._ring_write(self.buffer_valid, valid)
+        if self.opt.prioritized_replay:
+            self.sum_tree.update((self.ptr + np.arange(n)) % self.max_size, valid * self.max_priority)
+            self._ring_write(self.generation, self.written + np.arange(n))
+        if self.opt.model == "cnn" and len(evicted):
+            # windows starting at frames that left the compressed arena can't be sampled anymore,
+            # the frames after them are newer and still there
+            self.buffer_valid[evicted] = False
+            if self.opt.prioritized_replay:
+                self.sum_tree.update(evicted, 0.0)
+
+        self.ptr = (self.ptr + n) % self.max_size
+        self.size = min(self.size + n, self.max_size)
+        self.written += n
+        self.actor_steps += num_windows * self.opt.num_buffers
+
+    def _ring_write(self, buf, data):
+        if isinstance(buf, TieredArray):
+            buf.write(self.ptr, data)
+            return
+        first = min(len(data), self.max_size - self.ptr)
+        buf[self.ptr:self.ptr + first] = data[:first]
+        buf[:len(data) - first] = data[first:]
+
+    def _gather(self, idxs):
+        # buffer rows of the n-step windows starting at idxs, shape (batch, Ln + 1)
+        # speed up slice using fancy indexing and broadcasting
+        rows = (idxs[:, None] + np.arange(self.opt.Ln + 1)) % self.max_size
+        if self.opt.model == "cnn":
+            # the preallocated frames only fit single batches
+            obs = self.image_store.read(rows, self.obs_out if len(idxs) == self.opt.batch_size else None)
+        else:
+            obs = self.buffer_o[rows]
+        return dict(obs=obs,
+                    acts=self.buffer_a[rows[:, :-1]],
+                    rews=self.buffer_r[rows[:, :-1]],
+                    done=self.buffer_d[rows[:, :-1]], )
 
     def sample_batch(self):
-        idxs = np.random.randint(0, self.size, size=self.opt.batch_size)
-        # idxs2 = np.random.randint(0, self.opt.buffer_store_len-self.opt.Ln, size=1)[0]
-
-        self.learner_steps += 1 * self.opt.num_buffers
-
-        # buffer_o shape: (buffer size, max_ep_len, obs)
-        # speed up slice using fancy indexing and broadcasting
-        # return dict(obs=self.buffer_o[idxs[:, None], np.arange(idxs2, idxs2 + self.opt.Ln + 1)],
-        #             acts=self.buffer_a[idxs[:, None], np.arange(idxs2, idxs2 + self.opt.Ln)],
-        #             rews=self.buffer_r[idxs[:, None], np.arange(idxs2, idxs2 + self.opt.Ln)],
-        #             done=self.buffer_d[idxs[:, None], np.arange(idxs2, idxs2 + self.opt.Ln)], )
-        return dict(obs=self.buffer_o[idxs],
-                    acts=self.buffer_a[idxs],
-                    rews=self.buffer_r[idxs],
-                    done=self.buffer_d[idxs], )
+        return self._sample(self.opt.batch_size)
+
+    def sample_batches(self, k):
+        """
+        k independent minibatches from a single draw of k * batch_size windows, in one call.
+        Every array gets a leading axis of size k, e.g. obs is (k, batch_size, Ln + 1) + obs_shape.
+        """
+        batch = self._sample(k * self.opt.batch_size)
+        return {key: value.reshape((k, self.opt.batch_size) + value.shape[1:]) if isinstance(value, np.ndarray)
+                else value for key, value in batch.items()}
+
+    def _sample(self, batch_size):
+        if self.opt.prioritized_replay:
+            return self.sample_prioritized_batch(batch_size)
+        # with a shared buffer, writers in other processes would overwrite the oldest windows mid gather
+        with self.lock:
+            idxs = self._sample_idxs(batch_size)
+
+            self.learner_steps += batch_size // self.opt.batch_size * self.opt.num_buffers
+
+            return self._gather(idxs)
+
+    def _sample_idxs(self, batch_size):
+        # draw rows by age, 0 being the newest row, between per-sample bounds
+        low, high = np.zeros(batch_size, dtype=np.int64), np.full(batch_size, self.size, dtype=np.int64)
+        if self.opt.tiered_buffer and self.size > self.opt.hot_buffer_size:
+            # hot_sample_fraction of the batch from the RAM tier, the rest from the disk tier
+            num_hot = int(batch_size * self.opt.hot_sample_fraction)
+            high[:num_hot] = self.opt.hot_buffer_size
+            low[num_hot:] = self.opt.hot_buffer_size
+
+        idxs = self._draw(low, high)
+        # redraw the rows no window starts at (segment tails), in the same tier. Tails are rare, so a few
+        # rounds almost always do, the rest is drawn from the valid rows directly
+        for _ in range(10):
+            invalid = ~self.buffer_valid[idxs]
+            if not invalid.any():
+                return idxs
+            idxs[invalid] = self._draw(low[invalid], high[invalid])
+        invalid = ~self.buffer_valid[idxs]
+        if invalid.any():
+            idxs[invalid] = self._draw_valid(low[invalid], high[invalid])
+        return idxs
+
+    def _draw(self, low, high):
+        ages = low + (np.random.random(len(low)) * (high - low)).astype(np.int64)
+        return (self.ptr - 1 - ages) % self.max_size
+
+    def _draw_valid(self, low, high):
+        # a valid row per [low, high) age range, or from the whole buffer for ranges without any
+        valid_ages = np.flatnonzero(self.buffer_valid[(self.ptr - 1 - np.arange(self.size)) % self.max_size])
+        assert len(valid_ages), "no window to sample in the buffer"
+        ages = np.empty(len(low), dtype=np.int64)
+        for j in range(len(low)):
+            in_range = valid_ages[(valid_ages >= low[j]) & (valid_ages < high[j])]
+            in_range = in_range if len(in_range) else valid_ages
+            ages[j] = in_range[np.random.randint(len(in_range))]
+        return (self.ptr - 1 - ages) % self.max_size
+
+    def sample_prioritized_batch(self, batch_size):
+        # rows no window starts at have zero priority and are never drawn
+        idxs, priorities = self.sum_tree.sample(batch_size)
+        self.learner_steps += batch_size // self.opt.batch_size * self.opt.num_buffers
+        if batch_size > self.opt.batch_size:
+            # the draw is stratified over the priority mass, spread every stratum over all the minibatches
+            perm = np.random.permutation(batch_size)
+            idxs, priorities = idxs[perm], priorities[perm]
+
+        # importance sampling weights, normalized so the largest one in each minibatch is 1
+        weights = (self.size * priorities / self.sum_tree.total()) ** -self.opt.priority_beta
+        weights = weights.reshape((-1, self.opt.batch_size))
+        weights = (weights / weights.max(axis=1, keepdims=True)).reshape(-1)
+
+        batch = self._gather(idxs)
+        batch.update(weights=weights.astype(np.float32),
+                     idxs=idxs,
+                     generations=self.generation[idxs],
+                     buffer_index=self.buffer_index, )
+        return batch
+
+    def update_priorities(self, idxs, td_errors, generations):
+        priorities = (np.abs(td_errors) + self.opt.priority_eps) ** self.opt.priority_alpha
+        # rows rewritten since they were sampled hold another window now, its priority stays; rows
+        # invalidated since (evicted frames) must stay at zero priority
+        current = self.generation[idxs] == generations
+        idxs, priorities = idxs[current], priorities[current]
+        self.sum_tree.update(idxs, priorities * self.buffer_valid[idxs])
+        if len(priorities):
+            self.max_priority = max(self.max_priority, priorities.max())
 
     def get_counts(self):
         return self.learner_steps, self.actor_steps, self.size
 
     def save(self):
-        np.save(opt.save_dir + "/checkpoint/" + 'buffer_o-' + str(self.buffer_index), self.buffer_o)
-        np.save(opt.save_dir + "/checkpoint/" + 'buffer_a-' + str(self.buffer_index), self.buffer_a)
-        np.save(opt.save_dir + "/checkpoint/" + 'buffer_r-' + str(self.buffer_index), self.buffer_r)
-        np.save(opt.save_dir + "/checkpoint/" + 'buffer_d-' + str(self.buffer_index), self.buffer_d)
-        buffer_counts = np.array((self.ptr, self.size, self.max_size, self.actor_steps, self.learner_steps))
-        np.save(opt.save_dir + "/checkpoint/" + 'buffer_counts-' + str(self.buffer_index), buffer_counts)
-        print("****** buffer " + str(self.buffer_index) + " saved! ******")
+        """
+        Incremental checkpoint. The rows written since the last checkpoint are copied here and written
+        as one compressed chunk by a background thread, so store and sample_batch keep being served.
+        Chunks are listed in manifest.json and dropped once newer chunks cover all their rows.
+        """
+        if self.save_thread is not None:
+            self.save_thread.join()
+
+        with self.lock:
+            chunk, counts = self._snapshot()
+        self.save_thread = threading.Thread(target=self._write_checkpoint, args=(chunk, counts))
+        self.save_thread.daemon = True
+        self.save_thread.start()
+
+    def _snapshot(self):
+        num_rows = min(self.written - self.checkpointed, self.max_size)
+        rows = (self.written - num_rows + np.arange(num_rows)) % self.max_size
+        chunk = dict(rows=rows, buffer_valid=self.buffer_valid[rows])
+        if self.opt.model == "cnn":
+            # the rows of evicted frames are invalid already, their frames come back empty
+            chunk['buffer_o'] = self.image_store.get_frames(rows)
+        else:
+            # tiered columns too: their spill files keep being overwritten after the checkpoint
+            chunk['buffer_o'] = self.buffer_o[rows]
+        chunk['buffer_a'] = self.buffer_a[rows]
+        chunk['buffer_r'] = self.buffer_r[rows]
+        chunk['buffer_d'] = self.buffer_d[rows]
+        if self.opt.prioritized_replay:
+            chunk['priorities'] = self.sum_tree.get(rows)
+        counts = dict(ptr=int(self.ptr), size=int(self.size), actor_steps=int(self.actor_steps),
+                      learner_steps=int(self.learner_steps), written=int(self.written))
+        self.checkpointed = self.written
+        return chunk, counts
+
+    def _write_checkpoint(self, chunk, counts):
+        checkpoint_dir = self.opt.save_dir + "/checkpoint/buffer-" + str(self.buffer_index)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        if isinstance(chunk.get('buffer_o'), list):
+            # compressed frames are stored back to back with their lengths
+            chunk['buffer_o_lengths'] = np.array([len(f) for f in chunk['buffer_o']], dtype=np.int64)
+            chunk['buffer_o'] = np.frombuffer(b"".join(chunk['buffer_o']), dtype=np.uint8)
+
+        manifest = self._read_manifest(checkpoint_dir)
+        if len(chunk['rows']):
+            # write to a temporary name and rename, so a crash never leaves a partial file behind
+            chunk_file = 'chunk-' + str(counts['written']) + '.npz'
+            np.savez_compressed(checkpoint_dir + '/tmp-' + chunk_file, **chunk)
+            os.rename(checkpoint_dir + '/tmp-' + chunk_file, checkpoint_dir + '/' + chunk_file)
+            manifest['chunks'].append(dict(file=chunk_file, written=counts['written'], rows=len(chunk['rows'])))
+        # chunks whose rows have all been overwritten since are not needed to restore the buffer
+        stale = [c for c in manifest['chunks'] if c['written'] <= counts['written'] - self.max_size]
+        manifest['chunks'] = [c for c in manifest['chunks'] if c not in stale]
+        manifest['counts'] = counts
+        with open(checkpoint_dir + '/tmp-manifest.json', 'w') as fp:
+            json.dump(manifest, fp, indent=4)
+        os.rename(checkpoint_dir + '/tmp-manifest.json', checkpoint_dir + '/manifest.json')
+        for c in stale:
+            os.remove(checkpoint_dir + '/' + c['file'])
+        print("****** buffer " + str(self.buffer_index) + " saved! ******", len(chunk['rows']), "new rows")
+
+    @staticmethod
+    def _read_manifest(checkpoint_dir):
+        if not os.path.exists(checkpoint_dir + '/manifest.json'):
+            return dict(chunks=[], counts=None)
+        with open(checkpoint_dir + '/manifest.json') as fp:
+            return json.load(fp)
 
     def load(self, checkpoint_path):
         if not checkpoint_path:
             checkpoint_path = opt.save_dir + "/checkpoint"
-        if opt.obs_shape != (115,):
-            self.buffer_o = np.load(checkpoint_path + '/buffer_o-' + str(self.buffer_index) + '.npy')
-        else:
-            self.buffer_o = np.load(checkpoint_path + '/buffer_o-' + str(self.buffer_index) + '.npy')
-        self.buffer_a = np.load(checkpoint_path + '/buffer_a-' + str(self.buffer_index) + '.npy')
-        self.buffer_r = np.load(checkpoint_path + '/buffer_r-' + str(self.buffer_index) + '.npy')
-        self.buffer_d = np.load(checkpoint_path + '/buffer_d-' + str(self.buffer_index) + '.npy')
-        buffer_counts = np.load(checkpoint_path + '/buffer_counts-' + str(self.buffer_index) + '.npy')
-        self.ptr, self.size, self.max_size, self.actor_steps, self.learner_steps = buffer_counts[0], buffer_counts[1], buffer_counts[2], buffer_counts[3], buffer_counts[4]
+        checkpoint_dir = checkpoint_path + "/buffer-" + str(self.buffer_index)
+        manifest = self._read_manifest(checkpoint_dir)
+        if self.opt.model == "cnn" and manifest['chunks']:
+            # the chunks after the first one continue its rows
+            first = manifest['chunks'][0]
+            self.image_store.seek((first['written'] - first['rows']) % self.max_size)
+
+        # replay the chunks oldest first, newer rows overwrite older ones
+        for c in manifest['chunks']:
+            chunk = np.load(checkpoint_dir + '/' + c['file'])
+            rows = chunk['rows']
+            self.buffer_valid[rows] = chunk['buffer_valid']
+            if self.opt.model == "cnn":
+                frames = chunk['buffer_o']
+                if 'buffer_o_lengths' in chunk:
+                    ends = np.cumsum(chunk['buffer_o_lengths'])
+                    frames = [frames[end - length:end].tobytes()
+                              for end, length in zip(ends, chunk['buffer_o_lengths'])]
+                    # one frame per write packs the arena at least as tightly as the segments the frames were
+                    # stored in, the whole chunk at once could start a new lap and evict the frames before it
+                    for row, frame in zip(rows, frames):
+                        self.buffer_valid[self.image_store.write(row, [frame])] = False
+                else:
+                    self.image_store.write(rows[0], frames)
+            else:
+                self._load_rows(self.buffer_o, rows, chunk['buffer_o'])
+            self._load_rows(self.buffer_a, rows, chunk['buffer_a'])
+            self._load_rows(self.buffer_r, rows, chunk['buffer_r'])
+            self._load_rows(self.buffer_d, rows, chunk['buffer_d'])
+            if self.opt.prioritized_replay:
+                self.sum_tree.update(rows, chunk['priorities'] * self.buffer_valid[rows])
+                self.generation[rows] = c['written'] - len(rows) + np.arange(len(rows))
+        if self.opt.prioritized_replay:
+            self.max_priority = max(1.0, self.sum_tree.get(np.arange(self.sum_tree.capacity)).max())
+
+        counts = manifest['counts']
+        self.ptr, self.size, self.actor_steps, self.learner_steps = \
+            counts['ptr'], counts['size'], counts['actor_steps'], counts['learner_steps']
+        self.written = self.checkpointed = counts['written']
+        if self.opt.tiered_buffer:
+            for buf in (self.buffer_o, self.buffer_a, self.buffer_r, self.buffer_d):
+                buf.restore(self.written)
         print("****** buffer number " + str(self.buffer_index) + " restored! ******")
         print("****** buffer number " + str(self.buffer_index) + " info:", self.ptr, self.size, self.max_size, self.actor_steps, self.learner_steps)
 
+    @staticmethod
+    def _load_rows(buf, rows, data):
+        # tiered columns are restored through their spill file, restore() then reloads the hot rows from it
+        if isinstance(buf, TieredArray):
+            buf.cold[rows] = data
+        else:
+            buf[rows] = data
+
+
+RemoteReplayBuffer = ray.remote(num_cpus=2)(ReplayBuffer)
+
 
 @ray.remote
 class ParameterServer(object):
+    """
+    One shard of the weights, the variables named by keys, see ParameterServerShards.
+    """
+
     def __init__(self, opt, keys, values, weights_file="", checkpoint_path=""):
+        # bumped by every push, callers pass the version they hold to pull_if_newer
+        self.version = 0
+        # ObjectRefs of what was ray.put for the current version, see _snapshot
+        self.snapshots, self.snapshot_version = {}, 0
         # These values will be mutated, so we must create a copy that is not
         # backed by the object store.
         self.opt = opt
@@ -129,7 +430,10 @@ class ParameterServer(object):
             checkpoint_path = opt.save_dir + "/checkpoint"
 
         if opt.recover:
-            with open(checkpoint_path + "/checkpoint_weights.pickle", "rb") as pickle_in:
+            checkpoint = latest_checkpoint(checkpoint_path)
+            if checkpoint is None:
+                raise IOError("no checkpoint found in " + checkpoint_path)
+            with open(checkpoint, "rb") as pickle_in:
                 self.weights = pickle.load(pickle_in)
                 print("****** weights restored! ******")
 
@@ -147,191 +451,242 @@ class ParameterServer(object):
         if not opt.recover and not weights_file:
             values = [value.copy() for value in values]
             self.weights = dict(zip(keys, values))
-
-    def push(self, keys, values):
-        values = [value.copy() for value in values]
-        for key, value in zip(keys, values):
-            self.weights[key] = value
-
-    def pull(self, keys):
-        return [self.weights[key] for key in keys]
+        else:
+            # restored weights hold the variables of every shard
+            self.weights = {key: self.weights[key] for key in keys}
+
+        # weights travel as one flat float32 vector laid out by self.layout, policy variables first,
+        # self.weights keeps views into it by name for saving
+        keys = sorted(self.weights.keys(), key=lambda key: opt.policy_scope not in key)
+        self.layout = WeightLayout(keys, [np.shape(self.weights[key]) for key in keys])
+        self.flat = self.layout.flatten(self.weights)
+        self.weights = self.layout.unflatten(self.flat)
+        self.encoder = WeightEncoder(transport_layout(self.layout, opt.policy_scope, opt.weights_fp16),
+                                     opt.weights_fp16, opt.weights_keyframe_interval)
+
+    def get_layout(self):
+        return self.layout
+
+    def push(self, flat):
+        # a single copy, the views in self.weights follow
+        self.flat[:] = flat
+        self.version += 1
+
+    def pull(self):
+        return self.flat
+
+    def pull_if_newer(self, version):
+        # (version, ObjectRef of the flat weights), the ref is None if the caller's version is current
+        if version == self.version:
+            return self.version, None
+        return self.version, self._snapshot("flat", self.flat)
+
+    def pull_encoded(self, version, keyframe_version):
+        # pull_if_newer for rollout workers, in the transport encoding of self.encoder
+        if version == self.version:
+            return self.version, None
+        payload = self.encoder.encode(self.flat, self.version, keyframe_version)
+        return self.version, self._snapshot("keyframe" if payload[1] else "delta", payload)
+
+    def _snapshot(self, name, value):
+        # each version is ray.put once and the callers only get its ObjectRef, so the weights reach
+        # the workers through the object store instead of one copy per call in this actor's replies
+        if self.snapshot_version != self.version:
+            self.snapshots, self.snapshot_version = {}, self.version
+        if name not in self.snapshots:
+            self.snapshots[name] = ray.put(value)
+        return self.snapshots[name]
 
     def get_weights(self):
         return copy.deepcopy(self.weights)
 
-    # save weights to disk
-    def save_weights(self):
-        with open(opt.save_dir + "/checkpoint/" + "checkpoint_weights.pickle", "wb") as pickle_out:
-            pickle.dump(self.weights, pickle_out)
-
-
-class Cache(object):
-
-    def __init__(self, replay_buffer):
-        # cache for training data and model weights
-        print('os.pid:', os.getpid())
-        self.replay_buffer = replay_buffer
-        self.q1 = multiprocessing.Queue(10)
-        self.q2 = multiprocessing.Queue(5)
-        self.p1 = multiprocessing.Process(target=self.ps_update, args=(self.q1, self.q2, self.replay_buffer))
-        self.p1.daemon = True
-
-    def ps_update(self, q1, q2, replay_buffer):
-        print('os.pid of put_data():', os.getpid())
-
-        q1.put(copy.deepcopy(ray.get(replay_buffer[np.random.choice(opt.num_buffers, 1)[0]].sample_batch.remote())))
-
-        while True:
-            # print(q1.qsize())
-            if q1.qsize() < 10:
-                q1.put(copy.deepcopy(
-                    ray.get(replay_buffer[np.random.choice(opt.num_buffers, 1)[0]].sample_batch.remote())))
-
-            if not q2.empty():
-                keys, values = q2.get()
-                ps.push.remote(keys, values)
-
-    def start(self):
-        self.p1.start()
-        self.p1.join(10)
-
-    def end(self):
-        self.p1.terminate()
-
 
 # TODO
 @ray.remote(num_cpus=2)
-def worker_train(ps, replay_buffer, opt, learner_index):
+def worker_train(ps, replay_buffer, rate_limiter, opt, learner_index):
     agent = Learner(opt, job="learner")
-    keys = agent.get_weights()[0]
-    weights = ray.get(ps.pull.remote(keys))
-    agent.set_weights(keys, weights)
+    agent.set_flat_weights(ps.layout, ps.pull())
 
-    cache = Cache(replay_buffer)
-
-    cache.start()
+    if opt.shared_buffer:
+        # sample straight from the shared memory of the buffers, without actor calls or a prefetcher
+        buffers = [ReplayBuffer(opt, i, attach=True) for i in range(opt.num_buffers)]
+    else:
+        prefetcher = BatchPrefetcher(replay_buffer, opt.prefetch_inflight, opt.prefetch_queue_size,
+                                     batches_per_request=opt.batches_per_request, rate_limiter=rate_limiter)
+        prefetcher.start()
 
     cnt = 1
     while True:
         # time1 = time.time()
-        batch = cache.q1.get()
+        if opt.shared_buffer:
+            if (cnt - 1) % opt.batches_per_request == 0:
+                ray.get(rate_limiter.await_sample.remote(opt.batches_per_request))
+            batch = buffers[np.random.choice(opt.num_buffers, 1)[0]].sample_batch()
+        else:
+            batch = prefetcher.get()
         # time2 = time.time()
-        # print('cache get time:', time2-time1)
-        if opt.model == "cnn":
-            batch['obs'] = np.array([[unpack(o) for o in lno] for lno in batch['obs']])
-        agent.train(batch, cnt)
+        # print('prefetcher get time:', time2-time1)
+        td_errors = agent.train(batch, cnt)
+        if opt.prioritized_replay:
+            replay_buffer[batch['buffer_index']].update_priorities.remote(batch['idxs'], td_errors,
+                                                                          batch['generations'])
         # time3 = time.time()
         # print('agent train time:', time3 - time2)
         # TODO cnt % 300 == 0 before
         if cnt % 100 == 0:
-            cache.q2.put(agent.get_weights())
+            ps.push(agent.get_flat_weights(ps.layout))
         cnt += 1
 
 
-@ray.remote
-def worker_rollout(ps, replay_buffer, opt, worker_index):
+def store_segment(replay_buffer, rate_limiter, opt, o_seg, a_r_d_seg, worker_index):
+    """
+    Send the trajectory segment to a random buffer in one call. The last Ln steps are kept,
+    the next segment of the same episode needs them to complete its n-step windows.
+    With opt.shared_buffer, replay_buffer holds attached ReplayBuffers that are written directly.
+    """
+    if len(a_r_d_seg) < opt.Ln:
+        return
+    # wait here while the actors are too far ahead of the learners
+    ray.get(rate_limiter.await_insert.remote(len(a_r_d_seg) - opt.Ln + 1))
+    if opt.model == "cnn" and opt.compress_frames:
+        # variable-length compressed frames stay a list of bytes
+        obs = list(o_seg)
+    elif opt.model == "cnn":
+        obs = np.array(o_seg, dtype=np.uint8)
+    else:
+        obs = np.array(o_seg, dtype=np.float32)
+    acts = np.array([a for a, _, _ in a_r_d_seg], dtype=np.float32)
+    rews = np.array([r for _, r, _ in a_r_d_seg], dtype=np.float32)
+    done = np.array([d for _, _, d in a_r_d_seg], dtype=np.float32)
+
+    buffer = replay_buffer[np.random.choice(opt.num_buffers, 1)[0]]
+    if opt.shared_buffer:
+        buffer.store_many(obs, acts, rews, done, worker_index)
+    else:
+        buffer.store_many.remote(obs, acts, rews, done, worker_index)
+    del o_seg[:-opt.Ln]
+    del a_r_d_seg[:len(a_r_d_seg) - opt.Ln + 1]
 
-    agent = Actor(opt, job="worker")
-    keys = agent.get_weights()[0]
-    np.random.seed()
-    rand_buff1 = np.random.choice(opt.num_buffers, 1)[0]
 
-    random_steps = 0
+@ray.remote
+def worker_rollout(ps, replay_buffer, rate_limiter, opt, worker_index, inference_servers=None):
 
-    while True:
-        # ------ env set up ------
+    assert not opt.double_buffered_rollout or 0 < 2 * opt.env_pool_processes <= opt.envs_per_worker, \
+        "double buffering needs an env pool with two envs per process at least"
 
-        env = gym.make(opt.env_name)
-        # env = Wrapper(env, opt.action_repeat, opt.reward_scale)
-        # ------ env set up end ------
+    # ------ env set up ------
+    # opt.envs_per_worker envs stepped in lockstep, with one get_actions call for all of them, by
+    # opt.env_pool_processes subprocesses (forked before any TF session exists) or in this process if 0
+    make_env = lambda: gym.make(opt.env_name)
+    if opt.env_pool_processes > 0:
+        envs = EnvPool(make_env, opt.envs_per_worker, opt.env_pool_processes, opt.obs_space, opt.act_space)
+    else:
+        envs = LocalEnvs(make_env, opt.envs_per_worker, opt.obs_space, opt.act_space)
+    # env = Wrapper(env, opt.action_repeat, opt.reward_scale)
+    # ------ env set up end ------
 
-        o_queue = deque([], maxlen=opt.Ln + 1)
-        a_r_d_queue = deque([], maxlen=opt.Ln)
+    if inference_servers:
+        # env stepping only, the InferenceServer of this node acts and keeps the weights up to date
+        agent, refresher = RemotePolicy(inference_servers), None
+    else:
+        # the numpy policy needs no TF graph or session in the worker, the quantized one is a numpy policy too
+        agent = SoftmaxPolicy(opt) if opt.numpy_policy or opt.quantized_policy else Actor(opt, job="worker")
+        refresher = WeightRefresher(ps, agent, opt)
 
-        o, r, d, ep_ret, ep_len = env.reset(), 0, False, 0, 0
+    if opt.shared_buffer:
+        store_buffers = [ReplayBuffer(opt, i, attach=True) for i in range(opt.num_buffers)]
+    else:
+        store_buffers = replay_buffer
+    np.random.seed()
 
-        if opt.model == "cnn":
-            compressed_o = pack(o)
-            o_queue.append((compressed_o,))
-        else:
-            o_queue.append((o,))
+    random_steps = 0
 
-        t_queue = 1
+    # trajectory segment of the current episode of every env, sent to a buffer every opt.store_chunk_size
+    # n-step windows
+    o_segs, a_r_d_segs = [[] for _ in range(envs.num_envs)], [[] for _ in range(envs.num_envs)]
 
-        weights = ray.get(ps.pull.remote(keys))
-        agent.set_weights(keys, weights)
+    # obs rows are overwritten by the next step, the segments keep copies
+    obs, ep_rets, ep_lens = envs.reset(), [0] * envs.num_envs, [0] * envs.num_envs
+    episodes = 0
+    # env steps of this worker, times num_workers they estimate the steps of all the workers without asking
+    # the buffers
+    steps = 0
 
-        # for a_l_ratio control
-        np.random.seed()
-        rand_buff = np.random.choice(opt.num_buffers, 1)[0]
-        last_learner_steps, last_actor_steps, _size = ray.get(replay_buffer[rand_buff].get_counts.remote())
+    for o, o_seg in zip(obs, o_segs):
+        o_seg.append(compress_frame(o) if opt.model == "cnn" and opt.compress_frames else o.copy())
 
-        while True:
+    # groups of envs taking turns: with double_buffered_rollout one group steps in the env pool processes
+    # while the actions of the other one are computed, otherwise all the envs step together
+    groups = envs.groups(2 if opt.double_buffered_rollout else 1)
+    # actions of the step in flight of every group
+    group_acts = [None] * len(groups)
+    k = 0
 
-            # don't need to random sample action if load weights from local.
-            if random_steps > opt.start_steps or opt.weights_file or opt.recover:
-                a = agent.get_action(o, deterministic=False)
-            else:
-                a = env.action_space.sample()
-                random_steps += 1
-            # Step the env
-            o2, r, d, _ = env.step(a)
+    if refresher is not None:
+        refresher.pull()
 
-            ep_ret += r
-            ep_len += 1
+    while True:
+        # swap in newer weights once they have arrived, never waits for them
+        if refresher is not None:
+            refresher.step()
+
+        # don't need to random sample action if load weights from local.
+        if random_steps > opt.start_steps or opt.weights_file or opt.recover:
+            group_acts[k] = agent.get_actions(obs[groups[k]], deterministic=False)
+        else:
+            group_acts[k] = [opt.act_space.sample() for _ in groups[k]]
+            random_steps += len(groups[k])
+
+        # Step the envs of group k, then handle the step of the next group, the one in flight the longest
+        envs.step_async(groups[k], group_acts[k])
+        k = (k + 1) % len(groups)
+        if group_acts[k] is None:
+            # double buffering: the other group hasn't started yet
+            continue
+        envs.step_wait(groups[k])
+
+        for i in groups[k]:
+            # envs whose episode ended are reset already (see LocalEnvs), obs[i] starts the next episode
+            o2 = envs.final_obs[i] if envs.ended[i] else obs[i]
+            # the action the env executed, with the noise Wrapper.step adds in the env's process
+            a, r, d = envs.acts[i].copy(), envs.rews[i], envs.dones[i]
+
+            ep_rets[i] += r
+            ep_lens[i] += 1
+            steps += 1
 
             # Ignore the "done" signal if it comes from hitting the time
             # horizon (that is, when it's an artificial terminal signal
             # that isn't based on the agent's state)
             # d = False if ep_len*opt.action_repeat >= opt.max_ep_len else d
 
-            o = o2
-
-            a_r_d_queue.append((a, r, d,))
-            if opt.model == "cnn":
-                compressed_o2 = pack(o2)
-                o_queue.append((compressed_o2,))
-            else:
-                o_queue.append((o2,))
-
-            # scheme 1:
-            # TODO  and t_queue % 2 == 0: %1 lead to q smaller
-            # TODO
-            if t_queue >= opt.Ln and t_queue % opt.save_freq == 0:
-                replay_buffer[np.random.choice(opt.num_buffers, 1)[0]].store.remote(o_queue, a_r_d_queue, worker_index)
+            a_r_d_segs[i].append((a, r, d,))
+            o_segs[i].append(compress_frame(o2) if opt.model == "cnn" and opt.compress_frames else o2.copy())
 
-            t_queue += 1
+            if len(a_r_d_segs[i]) - opt.Ln + 1 >= opt.store_chunk_size:
+                store_segment(store_buffers, rate_limiter, opt, o_segs[i], a_r_d_segs[i], worker_index)
 
             # End of episode. Training (ep_len times).
             # if d or (ep_len * opt.action_repeat >= opt.max_ep_len):
-            if d:
-                sample_times, steps, _ = ray.get(replay_buffer[0].get_counts.remote())
-
-                print('rollout_ep_len:', ep_len * opt.action_repeat, 'rollout_ep_ret:', ep_ret)
+            if envs.ended[i]:
+                store_segment(store_buffers, rate_limiter, opt, o_segs[i], a_r_d_segs[i], worker_index)
 
-                if steps > opt.start_steps:
-                    # update parameters every episode
-                    weights = ray.get(ps.pull.remote(keys))
-                    agent.set_weights(keys, weights)
+                print('rollout_ep_len:', ep_lens[i] * opt.action_repeat, 'rollout_ep_ret:', ep_rets[i])
 
-                o, r, d, ep_ret, ep_len = env.reset(), 0, False, 0, 0
+                if steps * opt.num_workers > opt.start_steps and refresher is not None:
+                    # update parameters every episode, the next steps pick them up
+                    refresher.request()
 
+                episodes += 1
+                if opt.quantized_policy and refresher is not None and opt.quantized_policy_check_episodes > 0 and \
+                        episodes % opt.quantized_policy_check_episodes == 0:
+                    print('quantized_policy_divergence:', agent.divergence(obs[groups[k]]))
 
-                t_queue = 1
-                if opt.model == "cnn":
-                    compressed_o = pack(o)
-                    o_queue.append((compressed_o,))
-                else:
-                    o_queue.append((o,))
-
+                ep_rets[i], ep_lens[i] = 0, 0
 
-
-                # for a_l_ratio control
-                learner_steps, actor_steps, _size = ray.get(replay_buffer[rand_buff].get_counts.remote())
-
-                while (actor_steps - last_actor_steps) / (learner_steps - last_learner_steps + 1) > opt.a_l_ratio and last_learner_steps > 0:
-                    time.sleep(1)
-                    learner_steps, actor_steps, _size = ray.get(replay_buffer[rand_buff].get_counts.remote())
+                o_segs[i], a_r_d_segs[i] = [], []
+                o_segs[i].append(
+                    compress_frame(obs[i]) if opt.model == "cnn" and opt.compress_frames else obs[i].copy())
 
 
 @ray.remote
@@ -368,37 +723,53 @@ if __name__ == '__main__':
 
     # ------ end ------
 
+    net = Learner(opt, job="main")
+    all_keys, all_values = net.get_weights()
+    all_weights = dict(zip(all_keys, all_values))
+    shard_keys = partition_keys(all_keys, [np.size(value) for value in all_values], opt.num_ps_shards)
     if FLAGS.weights_file or FLAGS.recover:
-        ps = ParameterServer.remote(opt, [], [], weights_file=FLAGS.weights_file, checkpoint_path=FLAGS.checkpoint_path)
+        ps = [ParameterServer.remote(opt, keys, [], weights_file=FLAGS.weights_file,
+                                     checkpoint_path=FLAGS.checkpoint_path) for keys in shard_keys]
     else:
-        net = Learner(opt, job="main")
-        all_keys, all_values = net.get_weights()
-        ps = ParameterServer.remote(opt, all_keys, all_values)
+        ps = [ParameterServer.remote(opt, keys, [all_weights[key] for key in keys]) for keys in shard_keys]
+    ps = ParameterServerShards(ps)
 
     # Experience buffer
     # Methods called on different actors can execute in parallel,
     # and methods called on the same actor are executed serially in the order that they are called.
     # we need more buffer for more workers to keep high store speed.
-    replay_buffer = [ReplayBuffer.remote(opt, i) for i in range(opt.num_buffers)]
+    replay_buffer = [RemoteReplayBuffer.remote(opt, i) for i in range(opt.num_buffers)]
+    # the actors create the shared memory blocks the workers attach to
+    ray.get([replay_buffer[i].get_counts.remote() for i in range(opt.num_buffers)])
+
+    # a_l_ratio is enforced by blocking store_segment and the learners' sampling, not the buffers
+    rate_limiter = ray.remote(RateLimiter).remote(1.0 / opt.a_l_ratio,
+                                                  0 if opt.recover else opt.start_steps * opt.num_buffers,
+                                                  opt.rate_limit_error)
 
     if FLAGS.recover:
         buffer_load_op = [replay_buffer[i].load.remote(FLAGS.checkpoint_path) for i in range(opt.num_buffers)]
         ray.wait(buffer_load_op, num_returns=opt.num_buffers)
 
+    # one policy per node for the rollout workers, instead of one each
+    inference_servers = start_inference_servers(ps, opt) if opt.inference_server else None
+
     # Start some training tasks.
-    task_rollout = [worker_rollout.remote(ps, replay_buffer, opt, i) for i in range(FLAGS.num_workers)]
+    task_rollout = [worker_rollout.remote(ps, replay_buffer, rate_limiter, opt, i, inference_servers)
+                    for i in range(FLAGS.num_workers)]
 
     if not opt.recover:
-        # store at least start_steps in buffer before training
-        _, actor_steps, size = ray.get(replay_buffer[0].get_counts.remote())
-        while size < opt.start_steps:
-            _, actor_steps, size = ray.get(replay_buffer[0].get_counts.remote())
-            print('start steps before learning:', size, '/', opt.start_steps)
+        # store at least start_steps windows per buffer, counted over all the buffers, before training: the rate
+        # limiter lets no more than about that many in until the learners sample
+        _, size = ray.get(rate_limiter.get_counts.remote())
+        while size < opt.start_steps * opt.num_buffers:
+            _, size = ray.get(rate_limiter.get_counts.remote())
+            print('start steps before learning:', size, '/', opt.start_steps * opt.num_buffers)
             time.sleep(1)
     else:
         time.sleep(3)
 
-    task_train = [worker_train.remote(ps, replay_buffer, opt, i) for i in range(opt.num_learners)]
+    task_train = [worker_train.remote(ps, replay_buffer, rate_limiter, opt, i) for i in range(opt.num_learners)]
 
     time.sleep(10)
     while True:
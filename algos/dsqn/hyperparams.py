@@ -22,6 +22,9 @@ class HyperParameters:
 
         self.recover = False
         self.checkpoint_freq = 21600  # 21600s = 6h
+        # weight checkpoints kept in save_dir/checkpoint: the newest ones and the best by test reward
+        self.keep_last_checkpoints = 3
+        self.keep_best_checkpoints = 5
 
         # gpu memory fraction
         self.gpu_fraction = 0.3
@@ -59,11 +62,80 @@ class HyperParameters:
 
         # self.num_buffers = 1
         if self.model == 'cnn':
-            self.buffer_size = int(3e4)
+            self.buffer_size = int(3e5)
         else:
             self.buffer_size = int(1e6)
         self.num_buffers = self.num_workers // 25 + 1
+        # tiered replay: the newest hot_buffer_size rows of every buffer stay in RAM, older rows are
+        # spilled spill_size rows at a time to memory-mapped files under spill_dir (mlp only)
+        self.tiered_buffer = False
+        self.hot_buffer_size = int(3e6)
+        self.spill_size = int(1e4)
+        # fraction of every batch drawn from the RAM tier once the disk tier is in use
+        self.hot_sample_fraction = 0.5
+        if self.tiered_buffer:
+            self.buffer_size = int(1e8)
+
         self.buffer_size = self.buffer_size // self.num_buffers
+        if self.tiered_buffer:
+            # the tiers need buffer_size % hot_buffer_size == 0 and hot_buffer_size % spill_size == 0
+            self.hot_buffer_size = self.hot_buffer_size // self.num_buffers // self.spill_size * self.spill_size
+            self.buffer_size = self.buffer_size // self.hot_buffer_size * self.hot_buffer_size
+
+        # learners keep prefetch_inflight sample_batch calls in flight and up to prefetch_queue_size batches ready
+        self.prefetch_inflight = 4
+        self.prefetch_queue_size = 10
+        # minibatches fetched per sample_batches call, mlp train steps are too short to pay one call each
+        self.batches_per_request = 4 if self.model == "mlp" else 1
+
+        # rollout workers act with a NumPy copy of the policy instead of a TF Actor (mlp only)
+        self.numpy_policy = False
+        # the numpy policy acts with int8 weights, quantized per output channel when pulled; rollout workers print
+        # its action divergence from the float policy every quantized_policy_check_episodes episodes, 0 for never
+        self.quantized_policy = False
+        self.quantized_policy_check_episodes = 10
+        # envs every rollout worker steps in lockstep, acting for all of them with one batched sess.run
+        self.envs_per_worker = 1
+        # subprocesses the envs of a rollout worker are split over, writing their results to shared memory;
+        # 0 steps them in the rollout worker itself
+        self.env_pool_processes = 0
+        # the envs step in two groups taking turns, one steps in the env pool processes while the actions of the
+        # other are computed (needs env_pool_processes > 0 and envs_per_worker >= 2 * env_pool_processes)
+        self.double_buffered_rollout = False
+
+        # rollout workers only step envs and an InferenceServer per node acts for them, in batches of up to
+        # inference_max_batch observations sent at most inference_max_latency seconds after their first one
+        self.inference_server = False
+        self.inference_max_batch = 256
+        self.inference_max_latency = 0.002
+        # seconds between the weight pulls of an InferenceServer
+        self.inference_weights_interval = 1.0
+
+        # ParameterServer actors the weights are split over, by size
+        self.num_ps_shards = 1
+        # variables of the policy rollout workers act with, here the softmax over Q1
+        self.policy_scope = "main/q1"
+        # transport of the weights rollout workers pull: weights_fp16 sends only the policy variables, as float16;
+        # weights_keyframe_interval > 0 sends the versions between keyframes as compressed XORs against the last one
+        self.weights_fp16 = False
+        self.weights_keyframe_interval = 0
+        # env steps between the non-blocking weight pulls rollout workers make during an episode, 0 for none
+        self.weights_refresh_steps = 200
+
+        # single node: buffers in POSIX shared memory, rollouts store and learners sample without actor calls
+        self.shared_buffer = False
+        self.shared_buffer_name = 'replay' + str(os.getpid())
+
+        # cnn frames are kept lz4-compressed in a byte arena with this average budget per frame,
+        # or as raw uint8 arrays if compress_frames is False
+        self.compress_frames = True
+        self.compressed_frame_bytes = 2000
+
+        # sample with a sum tree by |TD error| ** priority_alpha instead of uniformly
+        self.prioritized_replay = False
+        self.priority_alpha = 0.6
+        self.priority_beta = 0.4
+        self.priority_eps = 1e-6
 
         self.start_steps = int(1e3) // self.num_buffers
         if self.weights_file:
@@ -81,6 +153,11 @@ class HyperParameters:
         # self.buffer_store_len = ceil(self.max_ep_len / self.action_repeat)
 
         self.save_freq = 1
+        # n-step windows a rollout worker accumulates before one store_many call
+        self.store_chunk_size = 64
+        # learner steps the learners may lag or lead a_l_ratio by before the rate limiter blocks a side,
+        # wider than one store_chunk_size segment so both sides always fit in the band
+        self.rate_limit_error = max(100.0, 2 * self.store_chunk_size / self.a_l_ratio)
 
         self.seed = 0
 
@@ -88,6 +165,7 @@ class HyperParameters:
 
         self.summary_dir = cwd + '/tboard_ray'  # Directory for storing tensorboard summary results
         self.save_dir = cwd + '/' + self.exp_name  # Directory for storing trained model
+        self.spill_dir = self.save_dir + '/spill'  # Directory for the tiered buffers' memory-mapped files
         self.save_interval = int(5e5)
 
         self.log_dir = self.summary_dir + "/" + str(datetime.datetime.now()) + "-workers_num:" + \
@@ -0,0 +1,123 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import ray
+
+from actor_learner import Actor
+from weight_refresh import WeightRefresher
+
+
+class InferenceServer(object):
+    """
+    Policy of the rollout workers of one node, run as an async Ray actor, SEED RL style.
+
+    The workers only step envs and send their observations to act(). Requests are coalesced into
+    batches of up to max_batch observations: a batch goes through one get_actions call as soon as it is
+    full, or max_latency seconds after its first request. The graph and the weights live only here, so
+    weights are pulled once per node instead of once per worker: a pull is requested every
+    weights_interval seconds and polled around every batch, like WeightRefresher does per env step in
+    the workers. A failed batch fails its act() calls, the server keeps serving.
+    """
+
+    def __init__(self, ps, opt):
+        self.agent = Actor(opt, job="worker")
+        self.refresher = WeightRefresher(ps, self.agent, opt)
+        self.refresher.pull()
+        self.weights_interval, self.last_request = opt.inference_weights_interval, time.time()
+        self.max_batch, self.max_latency = opt.inference_max_batch, opt.inference_max_latency
+        # (observations, future, arrival time) of the requests not sent yet
+        self.requests = []
+        # sess.run goes to this thread, so the event loop keeps taking requests meanwhile
+        self.executor = ThreadPoolExecutor(1)
+        # created in the actor's event loop by the first call
+        self.batcher, self.arrived, self.full = None, None, None
+
+    async def act(self, obs):
+        if self.batcher is None:
+            self.arrived, self.full = asyncio.Event(), asyncio.Event()
+            self.batcher = asyncio.ensure_future(self._run())
+        future = asyncio.get_event_loop().create_future()
+        self.requests.append((obs, future, time.time()))
+        self.arrived.set()
+        if self._num_waiting() >= self.max_batch:
+            self.full.set()
+        return await future
+
+    def _num_waiting(self):
+        return sum(len(o) for o, _, _ in self.requests)
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.arrived.wait()
+            # the deadline runs from the arrival of the oldest request, which may predate this wait
+            timeout = self.requests[0][2] + self.max_latency - time.time()
+            if timeout > 0 and not self.full.is_set():
+                try:
+                    await asyncio.wait_for(self.full.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            # whole requests up to max_batch observations, the rest wait for the next batch
+            num_obs, count = 0, 0
+            while count < len(self.requests) and (count == 0 or
+                                                  num_obs + len(self.requests[count][0]) <= self.max_batch):
+                num_obs += len(self.requests[count][0])
+                count += 1
+            requests, self.requests = self.requests[:count], self.requests[count:]
+            if not self.requests:
+                self.arrived.clear()
+            if self._num_waiting() < self.max_batch:
+                self.full.clear()
+
+            try:
+                acts = await loop.run_in_executor(self.executor, self._get_actions,
+                                                  np.concatenate([o for o, _, _ in requests]))
+            except Exception as e:
+                # the callers get the error, the batcher goes on with the next batch
+                for _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for o, future, _ in requests:
+                if not future.done():
+                    future.set_result(acts[start:start + len(o)])
+                start += len(o)
+
+    def _get_actions(self, obs):
+        # a pull_encoded call to every shard per batch would flood the ParameterServer shards
+        if time.time() - self.last_request >= self.weights_interval:
+            self.refresher.request()
+            self.last_request = time.time()
+        self.refresher.poll()
+        return self.agent.get_actions(obs, deterministic=False)
+
+
+def start_inference_servers(ps, opt):
+    """
+    One InferenceServer on every node, by node IP address.
+    """
+    servers = {}
+    for node in ray.nodes():
+        if node["Alive"]:
+            ip = node["NodeManagerAddress"]
+            servers[ip] = ray.remote(InferenceServer).options(
+                num_cpus=1, resources={"node:" + ip: 0.01}).remote(ps, opt)
+    return servers
+
+
+class RemotePolicy(object):
+    """
+    Stands in for the Actor of a rollout worker when the InferenceServer of its node acts for it.
+    """
+
+    def __init__(self, servers):
+        self.server = servers[ray.services.get_node_ip_address()]
+
+    def get_actions(self, o, deterministic=False):
+        # the server only acts stochastically, as rollouts do. ray.get gives a read-only view of the object
+        # store, Wrapper.step adds its noise to the actions in place
+        return np.array(ray.get(self.server.act.remote(o)))
@@ -0,0 +1,213 @@
+from numbers import Number
+
+import numpy as np
+
+LOG_STD_MAX = 2
+LOG_STD_MIN = -20
+
+
+class NumpyMLP(object):
+    """
+    The dense layers of one policy scope of the flat weights, evaluated with NumPy.
+
+    Layers are the <scope>/dense, dense_1, ... kernels and biases tf.layers.dense created, in creation
+    order. Activations go to preallocated per-layer buffers and the weights are views of the vector
+    given to set_flat_weights, so a forward pass allocates nothing but its outputs.
+    """
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.kernels, self.biases = [], []
+        self.buffers = {}
+
+    def set_flat_weights(self, layout, flat):
+        weights = layout.unflatten(flat)
+        layers = {}
+        for key, value in weights.items():
+            if key.startswith(self.scope + "/"):
+                layer, name = key.split("/")[-2:]
+                index = 0 if layer == "dense" else int(layer[len("dense_"):])
+                layers.setdefault(index, {})[name] = value
+        self.kernels = [layers[i]["kernel"] for i in sorted(layers)]
+        self.biases = [layers[i]["bias"] for i in sorted(layers)]
+
+    def layer(self, i, x, activation=None):
+        """
+        Output of dense layer i for the batch x, in a buffer that the next call for layer i reuses.
+        """
+        out = self.buffer(i, len(x), self.kernels[i].shape[1])
+        np.dot(x, self.kernels[i], out=out)
+        out += self.biases[i]
+        return activate(out, activation)
+
+    def buffer(self, name, rows, cols):
+        # one buffer per name, grown to the largest batch so far, smaller batches use its first rows
+        if name not in self.buffers or len(self.buffers[name]) < rows:
+            self.buffers[name] = np.empty((rows, cols), dtype=np.float32)
+        return self.buffers[name][:rows]
+
+
+class QuantizedMLP(NumpyMLP):
+    """
+    NumpyMLP with int8 weights: the kernels are quantized symmetrically per output channel when the weights
+    are set, the inputs of every layer per row on the fly, and the int32 accumulator of their product is
+    dequantized with the two scales before the bias is added.
+
+    NumPy has no int8 GEMM (its integer matmul doesn't go through BLAS), so the int8 values are kept in
+    float32 and multiplied with the float GEMM, which is exact as long as in_dim * 127 * 127 < 2 ** 24:
+    the accumulator holds the same integers an int8 kernel's would.
+    """
+
+    def __init__(self, scope):
+        super(QuantizedMLP, self).__init__(scope)
+        self.scales = []
+
+    def set_flat_weights(self, layout, flat):
+        super(QuantizedMLP, self).set_flat_weights(layout, flat)
+        kernels, self.scales = [], []
+        for kernel in self.kernels:
+            assert kernel.shape[0] * 127 * 127 < 2 ** 24, "layer too wide for exact float32 accumulation"
+            scale = quantization_scale(kernel, axis=0)
+            kernels.append(np.rint(kernel / scale).astype(np.float32))
+            self.scales.append(scale)
+        self.kernels = kernels
+
+    def layer(self, i, x, activation=None):
+        """
+        Output of dense layer i for the batch x, in a buffer that the next call for layer i reuses.
+        """
+        x_q = self.buffer(("input", i), len(x), x.shape[1])
+        x_scale = quantization_scale(x, axis=1)
+        np.divide(x, x_scale, out=x_q)
+        np.rint(x_q, out=x_q)
+        out = self.buffer(i, len(x), self.kernels[i].shape[1])
+        np.dot(x_q, self.kernels[i], out=out)
+        out *= x_scale
+        out *= self.scales[i]
+        out += self.biases[i]
+        return activate(out, activation)
+
+
+def quantization_scale(x, axis):
+    # symmetric int8 scale of every channel (reduced over axis), all-zero channels get 1 instead of 0
+    scale = np.abs(x).max(axis=axis, keepdims=True) / 127.0
+    scale[scale == 0] = 1.0
+    return scale.astype(np.float32)
+
+
+def activate(out, activation):
+    if activation == "relu":
+        np.maximum(out, 0, out=out)
+    elif activation == "tanh":
+        np.tanh(out, out=out)
+    return out
+
+
+class SoftmaxPolicy(object):
+    """
+    NumPy version of the rollout Actor of dsqn: core.softmax_policy over the Q1 MLP (mlp models without
+    batch norm). Drop-in for Actor in the rollout workers: set_flat_weights, get_action, get_actions.
+
+    With opt.quantized_policy it acts with a QuantizedMLP, and divergence() compares it to the float policy.
+    """
+
+    def __init__(self, opt):
+        assert opt.model == "mlp" and not opt.use_bn, "the numpy policy only evaluates plain mlp models"
+        self.float_mlp = NumpyMLP(opt.policy_scope)
+        self.mlp = QuantizedMLP(opt.policy_scope) if opt.quantized_policy else self.float_mlp
+        # with alpha == "auto" log_alpha is not on the ParameterServer, the TF Actor keeps its initial 1.0 too
+        self.alpha = opt.alpha if isinstance(opt.alpha, Number) else 1.0
+        self.scale_input = opt.obs_shape == (128,)  # for Breakout-ram-v4, see core.actor_critic
+
+    def set_flat_weights(self, layout, flat):
+        self.mlp.set_flat_weights(layout, flat)
+        if self.float_mlp is not self.mlp:
+            self.float_mlp.set_flat_weights(layout, flat)
+
+    def get_action(self, o, deterministic):
+        return self.get_actions(np.expand_dims(o, axis=0), deterministic)[0]
+
+    def get_actions(self, o, deterministic):
+        logits = self.logits(self.mlp, o)
+        if deterministic:
+            return logits.argmax(axis=1)
+        # softmax(logits / alpha) sampled by inverting its CDF
+        logits /= self.alpha
+        logits -= logits.max(axis=1, keepdims=True)
+        np.exp(logits, out=logits)
+        cdf = np.cumsum(logits, axis=1)
+        u = np.random.random((len(cdf), 1)) * cdf[:, -1:]
+        return np.minimum((cdf < u).sum(axis=1), cdf.shape[1] - 1)
+
+    def logits(self, mlp, o):
+        x = np.asarray(o, dtype=np.float32)
+        if self.scale_input:
+            x = (x - 128.0) / 128.0
+        num_layers = len(mlp.kernels)
+        for i in range(num_layers - 1):
+            x = mlp.layer(i, x, "relu")
+        return mlp.layer(num_layers - 1, x)
+
+    def divergence(self, o):
+        """
+        How far the acting policy is from the float one on the batch of observations o: the fraction of
+        greedy actions that differ and the mean total variation distance of the action distributions.
+        """
+        p = [softmax(self.logits(mlp, o) / self.alpha) for mlp in (self.mlp, self.float_mlp)]
+        return {"greedy_mismatch": float(np.mean(p[0].argmax(axis=1) != p[1].argmax(axis=1))),
+                "total_variation": float(np.mean(0.5 * np.abs(p[0] - p[1]).sum(axis=1)))}
+
+
+class SquashedGaussianPolicy(object):
+    """
+    NumPy version of the rollout Actor of sac1: core.mlp_gaussian_policy with the tanh squashing of
+    core.apply_squashing_func, scaled to the action space. Drop-in for Actor in the rollout workers.
+
+    With opt.quantized_policy it acts with a QuantizedMLP, and divergence() compares it to the float policy.
+    """
+
+    def __init__(self, opt):
+        assert opt.model == "mlp", "the numpy policy only evaluates plain mlp models"
+        self.float_mlp = NumpyMLP(opt.policy_scope)
+        self.mlp = QuantizedMLP(opt.policy_scope) if opt.quantized_policy else self.float_mlp
+        self.action_scale = opt.act_space.high[0]
+
+    def set_flat_weights(self, layout, flat):
+        self.mlp.set_flat_weights(layout, flat)
+        if self.float_mlp is not self.mlp:
+            self.float_mlp.set_flat_weights(layout, flat)
+
+    def get_action(self, o, deterministic=False):
+        return self.get_actions(np.expand_dims(o, axis=0), deterministic)[0]
+
+    def get_actions(self, o, deterministic=False):
+        mu, log_std = self.heads(self.mlp, o, deterministic)
+        if deterministic:
+            return np.tanh(mu) * self.action_scale
+        log_std = LOG_STD_MIN + 0.5 * (LOG_STD_MAX - LOG_STD_MIN) * (log_std + 1)
+        pi = mu + np.random.standard_normal(mu.shape).astype(np.float32) * np.exp(log_std)
+        return np.tanh(pi) * self.action_scale
+
+    def heads(self, mlp, o, deterministic):
+        # hidden layers, then the mu and log_std heads on the same features (log_std is None if deterministic)
+        x = np.asarray(o, dtype=np.float32)
+        num_layers = len(mlp.kernels)
+        for i in range(num_layers - 2):
+            x = mlp.layer(i, x, "relu")
+        mu = mlp.layer(num_layers - 2, x)
+        log_std = None if deterministic else mlp.layer(num_layers - 1, x, "tanh")
+        return mu, log_std
+
+    def divergence(self, o):
+        """
+        How far the acting policy is from the float one on the batch of observations o: the mean and max
+        absolute difference of their deterministic actions, in action space units.
+        """
+        diff = np.abs(np.tanh(self.heads(self.mlp, o, True)[0]) - np.tanh(self.heads(self.float_mlp, o, True)[0]))
+        diff *= self.action_scale
+        return {"mean_abs_diff": float(diff.mean()), "max_abs_diff": float(diff.max())}
+
+
+def softmax(logits):
+    p = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return p / p.sum(axis=1, keepdims=True)
@@ -0,0 +1,66 @@
+import queue
+import threading
+
+import numpy as np
+import ray
+
+
+class BatchPrefetcher(object):
+    """
+    Replay batch prefetcher running inside the learner process.
+
+    A background thread keeps num_inflight sample_batch calls in flight, spread round-robin over the
+    buffer actors, takes them with ray.wait in completion order and puts them in a ready queue of
+    queue_size batches, so the learner only waits when the buffers can't keep up with Learner.train.
+
+    With a rate_limiter, every request first waits for its sample tokens (see RateLimiter).
+    With batches_per_request > 1 every call is a sample_batches(batches_per_request), which is split
+    back into single batches, so the round trip and serialization costs are shared by that many steps.
+
+    Batches are handed over as ray.get returns them: their arrays are read-only views of the object
+    store, which is all Learner.train needs. copy=True gives writable copies instead.
+    """
+
+    def __init__(self, replay_buffer, num_inflight, queue_size, sample_args=(), batches_per_request=1,
+                 rate_limiter=None, copy=False):
+        self.replay_buffer = replay_buffer
+        self.rate_limiter = rate_limiter
+        self.num_inflight = num_inflight
+        self.batches_per_request = batches_per_request
+        self.sample_args = sample_args
+        self.copy = copy
+        self.ready = queue.Queue(queue_size)
+        self.next_buffer = np.random.randint(len(replay_buffer))
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def get(self):
+        return self.ready.get()
+
+    def _request(self):
+        if self.rate_limiter is not None:
+            ray.get(self.rate_limiter.await_sample.remote(self.batches_per_request))
+        buffer = self.replay_buffer[self.next_buffer]
+        self.next_buffer = (self.next_buffer + 1) % len(self.replay_buffer)
+        if self.batches_per_request > 1:
+            return buffer.sample_batches.remote(self.batches_per_request)
+        return buffer.sample_batch.remote(*self.sample_args)
+
+    def _run(self):
+        inflight = [self._request() for _ in range(self.num_inflight)]
+        while True:
+            done, inflight = ray.wait(inflight, num_returns=1)
+            # replace the request before blocking on a full queue
+            inflight.append(self._request())
+            batches = ray.get(done[0])
+            for i in range(self.batches_per_request):
+                if self.batches_per_request > 1:
+                    batch = {k: v[i] if isinstance(v, np.ndarray) else v for k, v in batches.items()}
+                else:
+                    batch = batches
+                if self.copy:
+                    batch = {k: v.copy() if isinstance(v, np.ndarray) else v for k, v in batch.items()}
+                self.ready.put(batch)
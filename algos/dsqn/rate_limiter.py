@@ -0,0 +1,56 @@
+import asyncio
+
+
+class RateLimiter(object):
+    """
+    Samples-per-insert rate limiter shared by all the buffer shards, run as an async Ray actor.
+
+    Rollout workers await_insert(n) before storing n n-step windows and learners await_sample(n) before
+    training on n batches. Like Reverb's SampleToInsertRatio, the calls are held (without blocking the
+    actor) while they would move inserts * samples_per_insert - samples out of the error_buffer wide
+    band around its target, and resume as soon as the other side catches up. No batch is sampled
+    before min_size_to_sample windows are inserted.
+    """
+
+    def __init__(self, samples_per_insert, min_size_to_sample, error_buffer):
+        self.samples_per_insert = samples_per_insert
+        self.min_size_to_sample = min_size_to_sample
+        offset = samples_per_insert * min_size_to_sample
+        self.min_diff, self.max_diff = offset - error_buffer, offset + error_buffer
+        self.inserts, self.samples = 0, 0
+        # created in the actor's event loop by the first call
+        self.condition = None
+
+    def _diff(self):
+        return self.inserts * self.samples_per_insert - self.samples
+
+    def _can_insert(self, n):
+        if self.inserts + n <= self.min_size_to_sample:
+            return True
+        # a request larger than the band still goes through once the learners are starving
+        return self._diff() + n * self.samples_per_insert <= self.max_diff or self._diff() <= self.min_diff
+
+    def _can_sample(self, n):
+        if self.inserts < self.min_size_to_sample:
+            return False
+        return self._diff() - n >= self.min_diff or self._diff() >= self.max_diff
+
+    async def await_insert(self, n):
+        async with self._get_condition():
+            await self.condition.wait_for(lambda: self._can_insert(n))
+            self.inserts += n
+            self.condition.notify_all()
+
+    async def await_sample(self, n):
+        async with self._get_condition():
+            await self.condition.wait_for(lambda: self._can_sample(n))
+            self.samples += n
+            self.condition.notify_all()
+
+    def _get_condition(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        return self.condition
+
+    def get_counts(self):
+        return self.samples, self.inserts
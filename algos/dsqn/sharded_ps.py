@@ -0,0 +1,64 @@
+import time
+
+import numpy as np
+import ray
+
+from flat_weights import concat_layouts
+
+
+def partition_keys(keys, sizes, num_shards):
+    """
+    Split variable names into num_shards groups of about the same total size, each variable going to the
+    smallest group so far, largest variables first. Names keep their order within a group.
+    """
+    loads = np.zeros(num_shards, dtype=np.int64)
+    groups = [[] for _ in range(num_shards)]
+    for i in sorted(range(len(keys)), key=lambda i: -sizes[i]):
+        shard = int(np.argmin(loads))
+        groups[shard].append(i)
+        loads[shard] += sizes[i]
+    return [[keys[i] for i in sorted(group)] for group in groups]
+
+
+class ParameterServerShards(object):
+    """
+    Client of the ParameterServer actors the weights are sharded over, passed to the learners and workers
+    in place of a single actor handle.
+
+    The flat weight vector is the shards' flat vectors back to back, laid out by self.layout. Learners push
+    every shard its slice, so each push bumps all the shard versions by one. Pulls go to all the shards in
+    parallel and only accept a version vector with a single version in it, i.e. every shard from the same
+    push: a pull that lands in the middle of a push is retried. With several learners the pushes of the
+    same version may still come from different learners, as they could already replace each other's.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.layouts = ray.get([shard.get_layout.remote() for shard in shards])
+        self.layout = concat_layouts(self.layouts)
+        self.bounds = np.cumsum([0] + [layout.size for layout in self.layouts])
+
+    def push(self, flat):
+        for shard, start, end in zip(self.shards, self.bounds[:-1], self.bounds[1:]):
+            shard.push.remote(flat[start:end])
+
+    def pull(self):
+        return self.pull_if_newer([-1] * len(self.shards))[1]
+
+    def pull_if_newer(self, versions):
+        """
+        Blocking, (version vector, flat weights), the weights are None if versions is current.
+        """
+        while True:
+            replies = ray.get([shard.pull_if_newer.remote(version) for shard, version in zip(self.shards, versions)])
+            if all(snapshot is None for _, snapshot in replies):
+                return versions, None
+            if consistent(replies):
+                return [version for version, _ in replies], \
+                    np.concatenate(ray.get([snapshot for _, snapshot in replies]))
+            time.sleep(0.01)
+
+
+def consistent(replies):
+    # (version, snapshot) replies of all the shards, taken together they are one push
+    return len(set(version for version, _ in replies)) == 1 and all(snapshot is not None for _, snapshot in replies)
@@ -0,0 +1,85 @@
+import atexit
+import fcntl
+import os
+import tempfile
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+
+class SharedArrays(object):
+    """
+    Numpy arrays in named POSIX shared memory blocks, so processes on the same node can map the same
+    replay buffer. One process creates the blocks (and unlinks them when it exits), the others attach
+    to them by name. Readers and writers serialize on an flock()ed lock file.
+
+    close() in the creating process unlinks the blocks and the lock file, it runs at exit. The mappings
+    stay valid until the processes using them exit, as the arrays may outlive the SharedArrays.
+    """
+
+    def __init__(self, prefix, create):
+        assert shared_memory is not None, "shared memory replay buffers need Python 3.8+"
+        self.prefix, self.create = prefix, create
+        self.blocks = []
+        self.lock = FileLock(os.path.join(tempfile.gettempdir(), prefix + '.lock'))
+        if create:
+            atexit.register(self.close)
+
+    def array(self, name, shape, dtype):
+        shape = tuple(shape)
+        nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        if self.create:
+            # new blocks are zero filled
+            block = shared_memory.SharedMemory(name=self.prefix + '_' + name, create=True, size=nbytes)
+        else:
+            block = shared_memory.SharedMemory(name=self.prefix + '_' + name)
+            # otherwise the resource tracker of this process unlinks the block when it exits
+            resource_tracker.unregister(block._name, 'shared_memory')
+        self.blocks.append(block)
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def close(self):
+        if self.create:
+            for block in self.blocks:
+                block.unlink()
+        self.blocks = []
+        self.lock.close(remove=self.create)
+
+
+class FileLock(object):
+    """
+    Inter-process lock usable with `with`, between processes that don't share a parent (e.g. Ray workers).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+    def __enter__(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def close(self, remove=False):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            if remove and os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def header_field(i):
+    # attribute backed by element i of self.header, an int64 array that may live in shared memory
+    def get(self):
+        return int(self.header[i])
+
+    def set(self, value):
+        self.header[i] = value
+
+    return property(get, set)
@@ -0,0 +1,47 @@
+import numpy as np
+
+
+class SumTree(object):
+    """
+    Array-based sum tree for prioritized replay.
+
+    tree[1] is the root and the leaves live in tree[num_leaves:], so the children of node i
+    are 2i and 2i+1. Batched updates and stratified sampling walk the tree one level at a time
+    for the whole batch, which keeps both at O(B log N) with no per-element Python loop.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.depth = int(np.ceil(np.log2(max(capacity, 2))))
+        self.num_leaves = 2 ** self.depth
+        self.tree = np.zeros(2 * self.num_leaves, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self, idxs, priorities):
+        nodes = np.asarray(idxs, dtype=np.int64) + self.num_leaves
+        self.tree[nodes] = priorities
+        # recompute parents from their children instead of adding deltas, so errors don't accumulate
+        for _ in range(self.depth):
+            nodes //= 2
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def sample(self, batch_size):
+        # one uniform draw in each of batch_size equal segments of the total priority mass
+        segment = self.tree[1] / batch_size
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * segment
+
+        nodes = np.ones(batch_size, dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sum = self.tree[left]
+            # never step into an empty subtree because of rounding at the segment edges
+            go_right = ((values >= left_sum) & (self.tree[left + 1] > 0)) | (left_sum <= 0)
+            values = np.where(go_right, values - left_sum, values)
+            nodes = left + go_right
+
+        return nodes - self.num_leaves, self.tree[nodes]
+
+    def get(self, idxs):
+        return self.tree[np.asarray(idxs, dtype=np.int64) + self.num_leaves]
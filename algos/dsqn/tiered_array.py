@@ -0,0 +1,85 @@
+import threading
+
+import numpy as np
+
+
+class TieredArray(object):
+    """
+    Ring array of `capacity` rows whose newest `hot_size` rows are kept in RAM and all older rows in a
+    np.memmap file on local disk, so the cold tier is served by the OS page cache instead of swap.
+
+    Rows are written sequentially into a RAM ring and spilled to the file in chunks of `spill_size`
+    contiguous rows before the RAM ring overwrites them. Row r of the logical ring lives in hot slot
+    r % hot_size and in file row r, which is why capacity must be a multiple of hot_size and hot_size
+    a multiple of spill_size.
+    """
+
+    def __init__(self, path, capacity, hot_size, spill_size, shape=(), dtype=np.float32, mode='w+'):
+        assert capacity % hot_size == 0 and hot_size % spill_size == 0, \
+            "capacity must be a multiple of hot_size and hot_size a multiple of spill_size"
+        self.capacity, self.hot_size, self.spill_size = capacity, hot_size, spill_size
+        self.shape, self.dtype = tuple(shape), dtype
+
+        self.hot = np.zeros((hot_size,) + self.shape, dtype=dtype)
+        # mode 'r+' reopens an existing file to restore() from
+        self.cold = np.memmap(path, dtype=dtype, mode=mode, shape=(capacity,) + self.shape)
+        # total rows written / spilled since the start, never wrapped
+        self.written, self.spilled = 0, 0
+        # spills happen in the writer's thread and in sync(), which may run in a checkpointing thread
+        self.spill_lock = threading.Lock()
+
+    def write(self, ptr, data):
+        """
+        Write data into rows ptr, ptr + 1, ... of the ring; ptr must be the row after the last write.
+        """
+        assert ptr == self.written % self.capacity, "TieredArray rows must be written sequentially"
+        n = len(data)
+        with self.spill_lock:
+            while self.written + n - self.spilled > self.hot_size:
+                self._spill(self.spill_size)
+
+        start = self.written % self.hot_size
+        first = min(n, self.hot_size - start)
+        self.hot[start:start + first] = data[:first]
+        self.hot[:n - first] = data[first:]
+        self.written += n
+
+    def _spill(self, n):
+        # one sequential write, split only where the hot ring or the file wraps
+        while n > 0:
+            hot_start, cold_start = self.spilled % self.hot_size, self.spilled % self.capacity
+            m = min(n, self.hot_size - hot_start, self.capacity - cold_start)
+            self.cold[cold_start:cold_start + m] = self.hot[hot_start:hot_start + m]
+            self.spilled += m
+            n -= m
+
+    def __getitem__(self, rows):
+        """
+        Gather an integer array of rows, from RAM for the newest hot_size rows and from the file otherwise.
+        """
+        rows = np.asarray(rows)
+        age = (self.written - 1 - rows) % self.capacity
+        hot = age < self.hot_size
+        out = np.empty(rows.shape + self.shape, dtype=self.dtype)
+        out[hot] = self.hot[rows[hot] % self.hot_size]
+        if not hot.all():
+            out[~hot] = self.cold[rows[~hot]]
+        return out
+
+    def sync(self, written=None):
+        """
+        Spill the rows up to `written` (all of them by default) still only in RAM and flush the file, e.g. for
+        a checkpoint. It may run in another thread than write(), which only waits for one spill_size chunk.
+        """
+        written = self.written if written is None else written
+        while self.spilled < written:
+            with self.spill_lock:
+                self._spill(min(self.spill_size, written - self.spilled))
+        self.cold.flush()
+
+    def restore(self, written):
+        # resume from a file holding the rows up to written, e.g. restored from a checkpoint, reloading the hot
+        # rows from it
+        self.written = self.spilled = written
+        rows = (written - 1 - np.arange(min(written, self.hot_size))) % self.capacity
+        self.hot[rows % self.hot_size] = self.cold[rows]
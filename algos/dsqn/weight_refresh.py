@@ -0,0 +1,69 @@
+import numpy as np
+import ray
+
+from flat_weights import concat_layouts
+from sharded_ps import consistent
+from weight_codec import WeightDecoder, transport_layout
+
+
+class WeightRefresher(object):
+    """
+    Keeps a rollout worker's Actor up to date with the ParameterServer shards without pausing the env.
+
+    request() sends a pull_encoded call to every shard unless some are in flight. poll() checks them with
+    ray.wait(timeout=0), then waits for the snapshots they point to the same way, and loads the decoded
+    weights as soon as they are all local. Replies from the middle of a push (see ParameterServerShards)
+    are dropped and asked again. step(), called once per env step, requests every interval steps and polls.
+    pull() is the blocking version, for startup.
+    """
+
+    def __init__(self, ps, agent, opt):
+        self.ps, self.agent = ps, agent
+        self.decoders = [WeightDecoder(transport_layout(layout, opt.policy_scope, opt.weights_fp16), opt.weights_fp16)
+                         for layout in ps.layouts]
+        self.layout = concat_layouts([decoder.layout for decoder in self.decoders])
+        self.interval = opt.weights_refresh_steps
+        # version vector of the weights the agent holds
+        self.versions = [-1] * len(ps.shards)
+        self.new_versions = self.versions
+        self.steps = 0
+        # ObjectRefs in flight: pull_encoded replies, or the snapshots they returned if is_snapshot
+        self.pending, self.is_snapshot = None, False
+
+    def pull(self):
+        self.request()
+        while self.pending is not None:
+            ray.wait(self.pending, num_returns=len(self.pending))
+            self.poll()
+
+    def request(self):
+        if self.pending is None:
+            self.pending = [shard.pull_encoded.remote(version, decoder.keyframe_version)
+                            for shard, version, decoder in zip(self.ps.shards, self.versions, self.decoders)]
+            self.is_snapshot = False
+
+    def step(self):
+        self.steps += 1
+        if self.interval > 0 and self.steps % self.interval == 0:
+            self.request()
+        self.poll()
+
+    def poll(self):
+        if self.pending is None or len(ray.wait(self.pending, num_returns=len(self.pending), timeout=0)[0]) < \
+                len(self.pending):
+            return
+        results, self.pending = ray.get(self.pending), None
+        if self.is_snapshot:
+            flat = np.concatenate([decoder.decode(payload) for decoder, payload in zip(self.decoders, results)])
+            self.agent.set_flat_weights(self.layout, flat)
+            self.versions = self.new_versions
+            return
+        if all(snapshot is None for _, snapshot in results):
+            return
+        if not consistent(results):
+            self.request()
+            return
+        # usually local already if the shards run on this node
+        self.new_versions = [version for version, _ in results]
+        self.pending, self.is_snapshot = [snapshot for _, snapshot in results], True
+        self.poll()
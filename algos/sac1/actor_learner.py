@@ -16,6 +16,42 @@ from core import get_vars
 from core import mlp_actor_critic as actor_critic
 
 
+class FlatWeightsOps(object):
+    """
+    Graph ops moving the flat weight vector of a WeightLayout in or out of a session in one sess.run:
+    a placeholder fed assign that splits it over the variables, and a concat of them. Built on first
+    use for each layout. Variables of the layout missing from the graph are skipped by assign.
+    """
+
+    def __init__(self, sess, variables):
+        self.sess = sess
+        # TensorFlowVariables.variables, name -> tf.Variable
+        self.variables = variables
+        self.ops = {}
+
+    def assign(self, layout, flat):
+        flat_ph, assign_op, _ = self._get_ops(layout)
+        self.sess.run(assign_op, feed_dict={flat_ph: flat})
+
+    def export(self, layout):
+        return self.sess.run(self._get_ops(layout)[2])
+
+    def _get_ops(self, layout):
+        key = tuple(layout.keys)
+        if key not in self.ops:
+            with self.sess.graph.as_default(), tf.name_scope('flat_weights'):
+                flat_ph = tf.placeholder(tf.float32, shape=(layout.size,))
+                parts = tf.split(flat_ph, np.diff(layout.offsets).tolist())
+                assign_op = tf.group([tf.assign(self.variables[name], tf.reshape(part, shape))
+                                      for name, shape, part in zip(layout.keys, layout.shapes, parts)
+                                      if name in self.variables])
+                export_op = None
+                if all(name in self.variables for name in layout.keys):
+                    export_op = tf.concat([tf.reshape(self.variables[name], [-1]) for name in layout.keys], axis=0)
+            self.ops[key] = flat_ph, assign_op, export_op
+        return self.ops[key]
+
+
 class Learner(object):
     def __init__(self, opt, job):
         self.opt = opt
@@ -62,10 +98,14 @@ class Learner(object):
             v_backup = tf.stop_gradient(min_q_pi - opt.alpha * logp_pi2)
             q_backup = self.r_ph + opt.gamma*(1-self.d_ph)*v_backup
 
+            # importance sampling weights, only fed with prioritized replay
+            self.is_weights_ph = tf.placeholder_with_default(tf.ones_like(q1), shape=(None,))
+            self.td_error = 0.5 * (tf.abs(q_backup - q1) + tf.abs(q_backup - q2))
+
             # Soft actor-critic losses
             pi_loss = tf.reduce_mean(opt.alpha * logp_pi - q1_pi)
-            q1_loss = 0.5 * tf.reduce_mean((q_backup - q1)**2)
-            q2_loss = 0.5 * tf.reduce_mean((q_backup - q2)**2)
+            q1_loss = 0.5 * tf.reduce_mean(self.is_weights_ph * (q_backup - q1)**2)
+            q2_loss = 0.5 * tf.reduce_mean(self.is_weights_ph * (q_backup - q2)**2)
             self.value_loss = q1_loss + q2_loss
 
             # Policy train op
@@ -121,16 +161,24 @@ class Learner(object):
 
             self.variables = ray.experimental.tf_utils.TensorFlowVariables(
                 self.value_loss, self.sess)
+            self.main_keys = [key for key in self.variables.variables.keys() if "main" in key]
+            self.flat_ops = FlatWeightsOps(self.sess, self.variables.variables)
 
     def set_weights(self, variable_names, weights):
         self.variables.set_weights(dict(zip(variable_names, weights)))
         self.sess.run(self.target_init)
 
     def get_weights(self):
-        weights = self.variables.get_weights()
-        keys = [key for key in list(weights.keys()) if "main" in key]
-        values = [weights[key] for key in keys]
-        return keys, values
+        values = self.sess.run([self.variables.variables[key] for key in self.main_keys])
+        return self.main_keys, values
+
+    def set_flat_weights(self, layout, flat):
+        # flat weight vector from the ParameterServer, see WeightLayout
+        self.flat_ops.assign(layout, flat)
+        self.sess.run(self.target_init)
+
+    def get_flat_weights(self, layout):
+        return self.flat_ops.export(layout)
 
     def train(self, batch):
         feed_dict = {self.x_ph: batch['obs1'],
@@ -139,7 +187,10 @@ class Learner(object):
                      self.r_ph: batch['rews'],
                      self.d_ph: batch['done'],
                      }
-        self.sess.run(self.step_ops, feed_dict)
+        if 'weights' in batch:
+            feed_dict[self.is_weights_ph] = batch['weights']
+        _, td_error = self.sess.run([self.step_ops, self.td_error], feed_dict)
+        return td_error
 
     def compute_gradients(self, x, y):
         pass
@@ -156,16 +207,15 @@ class Actor(object):
             np.random.seed(opt.seed)
 
             # Inputs to computation graph
-            self.x_ph, self.a_ph, self.x2_ph, self.r_ph, self.d_ph = \
-                core.placeholders(opt.obs_dim, opt.act_dim, opt.obs_dim, None, None)
+            self.x_ph, self.a_ph = core.placeholders(opt.obs_dim, opt.act_dim)
 
-            # Main outputs from computation graph
+            # Main outputs from computation graph, the policy alone: acting needs no critic or x2 branch
             with tf.variable_scope('main'):
-                self.mu, self.pi, logp_pi, logp_pi2, q1, q2, q1_pi, q2_pi = \
-                    actor_critic(self.x_ph, self.x2_ph, self.a_ph, action_space=opt.ac_kwargs["action_space"])
+                self.mu, self.pi = core.mlp_actor(self.x_ph, self.a_ph, action_space=opt.ac_kwargs["action_space"])
 
-            # Set up summary Ops
-            self.test_ops, self.test_vars = self.build_summaries()
+            if job == "main":
+                # Set up summary Ops
+                self.test_ops, self.test_vars = self.build_summaries()
 
             self.sess = tf.Session(
                 config=tf.ConfigProto(
@@ -182,19 +232,30 @@ class Actor(object):
 
             self.variables = ray.experimental.tf_utils.TensorFlowVariables(
                 self.pi, self.sess)
+            self.main_keys = [key for key in self.variables.variables.keys() if "main" in key]
+            self.flat_ops = FlatWeightsOps(self.sess, self.variables.variables)
+
+            # get_actions fast path, without a feed_dict or fetch list to build per call
+            self.act_fns = {True: self.sess.make_callable(self.mu, [self.x_ph]),
+                            False: self.sess.make_callable(self.pi, [self.x_ph])}
 
     def set_weights(self, variable_names, weights):
         self.variables.set_weights(dict(zip(variable_names, weights)))
 
     def get_weights(self):
-        weights = self.variables.get_weights()
-        keys = [key for key in list(weights.keys()) if "main" in key]
-        values = [weights[key] for key in keys]
-        return keys, values
+        values = self.sess.run([self.variables.variables[key] for key in self.main_keys])
+        return self.main_keys, values
+
+    def set_flat_weights(self, layout, flat):
+        # flat weight vector from the ParameterServer, see WeightLayout
+        self.flat_ops.assign(layout, flat)
 
     def get_action(self, o, deterministic=False):
-        act_op = self.mu if deterministic else self.pi
-        return self.sess.run(act_op, feed_dict={self.x_ph: o.reshape(1, -1)})[0]
+        return self.get_actions(o.reshape(1, -1), deterministic)[0]
+
+    def get_actions(self, o, deterministic=False):
+        # a batch of observations, e.g. one from each env of a vectorized rollout worker
+        return self.act_fns[deterministic](o)
 
     def test(self, test_env, replay_buffer, n=25):
 
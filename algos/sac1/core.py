@@ -88,6 +88,17 @@ def apply_squashing_func(mu, pi, logp_pi):
 
 
 # Actor-Critics
+def mlp_actor(x, a, hidden_sizes=(400,300), activation=tf.nn.relu,
+              output_activation=None, policy=mlp_gaussian_policy, action_space=None):
+    # the policy part of mlp_actor_critic alone, with the same variable names, for inference-only graphs
+    with tf.variable_scope('pi'):
+        mu, pi, logp_pi = policy(x, a, hidden_sizes, activation, output_activation)
+        mu, pi, logp_pi = apply_squashing_func(mu, pi, logp_pi)
+
+    action_scale = action_space.high[0]
+    return mu * action_scale, pi * action_scale
+
+
 def mlp_actor_critic(x, x2, a, hidden_sizes=(400,300), activation=tf.nn.relu,
                      output_activation=None, policy=mlp_gaussian_policy, action_space=None):
 
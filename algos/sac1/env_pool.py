@@ -0,0 +1,188 @@
+import mmap
+import multiprocessing
+import traceback
+
+import numpy as np
+
+
+class LocalEnvs(object):
+    """
+    num_envs envs stepped one after the other in this process, with the interface of EnvPool.
+
+    The obs, rews and dones arrays hold the latest result of every env. step() and reset() write into
+    them and return them, so their rows are overwritten by the next call: copy what must be kept.
+    acts holds the action every env executed in its last step, after any change the env made to it in
+    place (e.g. the noise of Wrapper).
+
+    An env whose episode ended in a step (done, or truncated by the caller, e.g. for a time limit) is
+    reset right away: ended[i] is set, final_obs[i] holds the last observation of the episode and
+    obs[i] the first one of the next.
+    """
+
+    def __init__(self, make_env, num_envs, obs_space, act_space):
+        self.num_envs = num_envs
+        self.envs = [make_env() for _ in range(num_envs)]
+        self.obs, self.final_obs = [np.zeros((num_envs,) + obs_space.shape, dtype=obs_space.dtype) for _ in range(2)]
+        self.rews = np.zeros(num_envs, dtype=np.float64)
+        self.dones, self.ended = np.zeros(num_envs, dtype=np.bool_), np.zeros(num_envs, dtype=np.bool_)
+        self.acts = np.zeros((num_envs,) + act_space.shape, dtype=act_space.dtype)
+
+    def reset(self, indices=None):
+        for i in range(self.num_envs) if indices is None else indices:
+            self.obs[i] = self.envs[i].reset()
+        return self.obs
+
+    def step(self, actions):
+        self.step_async(range(self.num_envs), actions)
+        self.step_wait(range(self.num_envs))
+        return self.obs, self.rews, self.dones
+
+    def step_async(self, indices, actions, truncate=None):
+        """
+        Start stepping the envs of indices with actions (one per index), step_wait(indices) completes it.
+        truncate, one flag per index, ends episodes that are not done after this step.
+        """
+        truncate = [False] * len(indices) if truncate is None else truncate
+        for i, action, truncated in zip(indices, actions, truncate):
+            step_env(self.envs[i], i, action, truncated,
+                     self.obs, self.final_obs, self.rews, self.dones, self.ended, self.acts)
+
+    def step_wait(self, indices):
+        pass
+
+    def groups(self, n):
+        """
+        The env indices split into n groups that can step independently.
+        """
+        return np.array_split(np.arange(self.num_envs), n)
+
+    def close(self):
+        pass
+
+
+class EnvPool(LocalEnvs):
+    """
+    num_envs envs run by num_processes subprocesses, each stepping a contiguous range of them.
+
+    The obs, rews, dones and acts arrays live in anonymous shared memory mapped by every process: the
+    subprocesses write their envs' rows in place and only the step and reset commands and their
+    acknowledgements go through the pipes, so no observation is pickled. step_async() returns as soon
+    as the commands are sent, which lets the caller run the policy while the envs step.
+
+    Every process runs its commands in the order they were sent, so envs of the same process can have
+    commands in flight together: step_wait() and reset() only wait for the acknowledgements up to the
+    last command of their envs.
+
+    The subprocesses are forked, so make_env can be any callable, e.g. a lambda.
+    """
+
+    def __init__(self, make_env, num_envs, num_processes, obs_space, act_space):
+        self.num_envs = num_envs
+        self.obs, self.final_obs = [shared_array((num_envs,) + obs_space.shape, obs_space.dtype) for _ in range(2)]
+        self.rews = shared_array((num_envs,), np.float64)
+        self.dones, self.ended = shared_array((num_envs,), np.bool_), shared_array((num_envs,), np.bool_)
+        self.acts = shared_array((num_envs,) + act_space.shape, act_space.dtype)
+
+        # env i is stepped by process self.owner[i]
+        self.owner = np.arange(num_envs) * num_processes // num_envs
+        # commands sent to and acknowledged by every process, and the number of the last command of every env
+        self.sent, self.acked = [0] * num_processes, [0] * num_processes
+        self.last_command = np.zeros(num_envs, dtype=np.int64)
+        self.pipes, self.processes = [], []
+        context = multiprocessing.get_context("fork")
+        for p in range(num_processes):
+            pipe, child_pipe = context.Pipe()
+            process = context.Process(target=env_worker, args=(
+                child_pipe, make_env, np.flatnonzero(self.owner == p),
+                (self.obs, self.final_obs, self.rews, self.dones, self.ended, self.acts)))
+            process.daemon = True
+            process.start()
+            child_pipe.close()
+            self.pipes.append(pipe)
+            self.processes.append(process)
+
+    def reset(self, indices=None):
+        indices = range(self.num_envs) if indices is None else indices
+        self._send("reset", indices, [None] * len(indices))
+        self._wait(indices)
+        return self.obs
+
+    def step_async(self, indices, actions, truncate=None):
+        truncate = [False] * len(indices) if truncate is None else truncate
+        self._send("step", indices, list(zip(actions, truncate)))
+
+    def step_wait(self, indices):
+        self._wait(indices)
+
+    def groups(self, n):
+        """
+        The env indices split into n groups that can step independently, dealt out over the envs of every
+        process so that each process has envs of every group to step (needs num_envs >= n * num_processes).
+        """
+        assert self.num_envs >= n * len(self.processes), "every process needs an env of every group"
+        local_index = np.arange(self.num_envs) - np.searchsorted(self.owner, self.owner)
+        return [np.flatnonzero(local_index % n == j) for j in range(n)]
+
+    def close(self):
+        for pipe in self.pipes:
+            pipe.send(("close", None))
+        for process in self.processes:
+            process.join()
+
+    def _send(self, command, indices, args):
+        # one command per process, for all of its envs among indices
+        commands = {}
+        for i, arg in zip(indices, args):
+            commands.setdefault(self.owner[i], []).append((i, arg))
+        for p, data in commands.items():
+            self.pipes[p].send((command, data))
+            self.sent[p] += 1
+            self.last_command[[i for i, _ in data]] = self.sent[p]
+
+    def _wait(self, indices):
+        indices = list(indices)
+        for p in np.unique(self.owner[indices]):
+            last = self.last_command[indices][self.owner[indices] == p].max()
+            while self.acked[p] < last:
+                error = self.pipes[p].recv()
+                self.acked[p] += 1
+                if error is not None:
+                    raise RuntimeError("env process " + str(p) + " failed:\n" + error)
+
+
+def shared_array(shape, dtype):
+    # anonymous shared mapping, inherited by forked processes
+    nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    return np.frombuffer(mmap.mmap(-1, nbytes), dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def step_env(env, i, action, truncated, obs, final_obs, rews, dones, ended, acts):
+    # step env i, resetting it if its episode ends, see LocalEnvs
+    o, rews[i], dones[i], _ = env.step(action)
+    acts[i] = action
+    ended[i] = dones[i] or truncated
+    if ended[i]:
+        final_obs[i] = o
+        o = env.reset()
+    obs[i] = o
+
+
+def env_worker(pipe, make_env, indices, arrays):
+    # forked processes start with the same random state (e.g. of the noise of Wrapper)
+    np.random.seed()
+    envs = {i: make_env() for i in indices}
+    obs = arrays[0]
+    while True:
+        command, data = pipe.recv()
+        if command == "close":
+            break
+        try:
+            for i, arg in data:
+                if command == "step":
+                    action, truncated = arg
+                    step_env(envs[i], i, action, truncated, *arrays)
+                else:
+                    obs[i] = envs[i].reset()
+            pipe.send(None)
+        except Exception:
+            pipe.send(traceback.format_exc())
@@ -0,0 +1,48 @@
+import numpy as np
+
+
+class WeightLayout(object):
+    """
+    Layout table of a flat float32 weight vector: the names, shapes and offsets of the variables in it.
+
+    The ParameterServer builds it once from its weights and hands it to every worker at startup,
+    after which weights travel as a single contiguous array instead of lists of arrays and names.
+    """
+
+    def __init__(self, keys, shapes):
+        self.keys = list(keys)
+        self.shapes = [tuple(shape) for shape in shapes]
+        sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.size = int(self.offsets[-1])
+
+    def flatten(self, weights):
+        """
+        Pack a dict of weights by name, or a list in layout order, into a new flat vector.
+        """
+        if isinstance(weights, dict):
+            weights = [weights[key] for key in self.keys]
+        flat = np.empty(self.size, dtype=np.float32)
+        for value, start, end in zip(weights, self.offsets[:-1], self.offsets[1:]):
+            flat[start:end] = np.ravel(value)
+        return flat
+
+    def unflatten(self, flat):
+        """
+        Dict of weights by name that are views into flat, nothing is copied.
+        """
+        return {key: flat[start:end].reshape(shape)
+                for key, shape, start, end in zip(self.keys, self.shapes, self.offsets[:-1], self.offsets[1:])}
+
+    def head(self, n):
+        """
+        Layout of the first n variables, whose flat vector is the first head(n).size values of this one.
+        """
+        return WeightLayout(self.keys[:n], self.shapes[:n])
+
+
+def concat_layouts(layouts):
+    """
+    Layout of the flat vectors of layouts put back to back.
+    """
+    return WeightLayout(sum([layout.keys for layout in layouts], []), sum([layout.shapes for layout in layouts], []))
@@ -0,0 +1,138 @@
+import numpy as np
+
+try:
+    import lz4.block
+
+    def compress_frame(frame):
+        return lz4.block.compress(np.ascontiguousarray(frame, dtype=np.uint8), store_size=False)
+
+    def decompress_frame(data, frame_bytes):
+        return lz4.block.decompress(data, uncompressed_size=frame_bytes)
+except ImportError:
+    import zlib
+
+    def compress_frame(frame):
+        return zlib.compress(np.ascontiguousarray(frame, dtype=np.uint8), 1)
+
+    def decompress_frame(data, frame_bytes):
+        return zlib.decompress(data)
+
+
+class ImageStore(object):
+    """
+    Ring storage for uint8 image observations, slot i holds the observation of buffer row i.
+
+    Raw mode keeps the frames in a (capacity,) + obs_shape uint8 array. Compressed mode keeps the
+    variable-length compressed frames back to back in a preallocated byte arena, with an offset and
+    length per slot. The arena is a ring too: when it wraps, the oldest frames are overwritten and
+    write() returns their slots so the replay buffer can drop the windows using them.
+    """
+
+    def __init__(self, capacity, obs_shape, compressed=True, arena_bytes=None):
+        self.capacity = capacity
+        self.obs_shape = tuple(obs_shape)
+        self.frame_bytes = int(np.prod(self.obs_shape))
+        self.compressed = compressed
+
+        if compressed:
+            self.arena = np.zeros(arena_bytes, dtype=np.uint8)
+            self.offsets = np.zeros(capacity, dtype=np.int64)
+            self.lengths = np.zeros(capacity, dtype=np.int64)
+            # logical (never wrapped) arena position of each frame, frames before
+            # total_bytes - len(arena) have been overwritten
+            self.starts = np.zeros(capacity, dtype=np.int64)
+            self.total_bytes = 0
+            self.frames_written, self.first_live = 0, 0
+        else:
+            self.frames = np.zeros((capacity,) + self.obs_shape, dtype=np.uint8)
+
+    def write(self, ptr, frames):
+        """
+        Write frames into slots ptr, ptr + 1, ... (wrapping around the ring). Frames are uint8 arrays
+        in raw mode and compress_frame() outputs in compressed mode. Returns the slots whose frames were
+        evicted from the arena by this write.
+        """
+        n = len(frames)
+        slots = (ptr + np.arange(n)) % self.capacity
+        if not self.compressed:
+            self.frames[slots] = frames
+            return slots[:0]
+
+        lengths = np.array([len(f) for f in frames], dtype=np.int64)
+        if lengths.sum() > len(self.arena):
+            # more than the arena holds (e.g. a restored checkpoint chunk): in slices that fit, the later
+            # ones evict the first ones
+            split = max(int(np.searchsorted(np.cumsum(lengths), len(self.arena), side='right')), 1)
+            evicted = self.write(ptr, frames[:split])
+            return np.concatenate([evicted, self.write((ptr + split) % self.capacity, frames[split:])])
+        blob = np.frombuffer(b"".join(frames), dtype=np.uint8)
+        assert len(blob) <= len(self.arena), "arena is smaller than one write"
+
+        # write the whole blob contiguously, starting a new lap of the arena if it doesn't fit
+        offset = self.total_bytes % len(self.arena)
+        if offset + len(blob) > len(self.arena):
+            self.total_bytes += len(self.arena) - offset
+            offset = 0
+        self.arena[offset:offset + len(blob)] = blob
+
+        starts = np.cumsum(lengths) - lengths
+        self.offsets[slots] = offset + starts
+        self.lengths[slots] = lengths
+        self.starts[slots] = self.total_bytes + starts
+        self.total_bytes += len(blob)
+        self.frames_written += n
+
+        return self._evict()
+
+    def seek(self, ptr):
+        """
+        Make the next write() start the write order at slot ptr, e.g. to restore a checkpoint whose oldest
+        rows don't start at slot 0 into an empty store. Evictions find the slots of frames by their order.
+        """
+        if self.compressed:
+            self.frames_written = self.first_live = ptr
+
+    def _evict(self):
+        # frames leave the arena in write order, so the dead ones are a prefix of the live ones
+        horizon = self.total_bytes - len(self.arena)
+        first = max(self.first_live, self.frames_written - self.capacity)
+        last = first
+        while last < self.frames_written:
+            frames = np.arange(last, min(last + 4096, self.frames_written))
+            num_dead = np.count_nonzero(self.starts[frames % self.capacity] < horizon)
+            last += num_dead
+            if num_dead < len(frames):
+                break
+        evicted = np.arange(first, last) % self.capacity
+        self.first_live = last
+        return evicted
+
+    def read(self, rows, out=None):
+        """
+        Gather the frames of an integer array of rows into a uint8 array of shape rows.shape + obs_shape.
+        """
+        if out is None:
+            out = np.empty(np.shape(rows) + self.obs_shape, dtype=np.uint8)
+        if not self.compressed:
+            out[...] = self.frames[rows]
+            return out
+
+        # n-step windows overlap, decode each distinct frame once
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        decoded = np.empty((len(unique_rows), self.frame_bytes), dtype=np.uint8)
+        for i, (offset, length) in enumerate(zip(self.offsets[unique_rows], self.lengths[unique_rows])):
+            decoded[i] = np.frombuffer(
+                decompress_frame(self.arena[offset:offset + length].tobytes(), self.frame_bytes), dtype=np.uint8)
+        out.reshape((-1, self.frame_bytes))[...] = decoded[inverse.reshape(-1)]
+        return out
+
+    def get_frames(self, rows):
+        """
+        Frames of rows in the form write() takes them, e.g. to checkpoint them. Frames evicted from the
+        arena come back empty, their bytes belong to newer frames.
+        """
+        if not self.compressed:
+            return self.frames[rows]
+        live = self.starts[rows] >= self.total_bytes - len(self.arena)
+        return [self.arena[offset:offset + length].tobytes() if is_live else b""
+                for offset, length, is_live in zip(self.offsets[rows], self.lengths[rows], live)]
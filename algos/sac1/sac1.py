@@ -6,10 +6,13 @@ import gym
 
 from hyperparams import HyperParameters, Wrapper
 from actor_learner import Actor, Learner
+from checkpoint_manager import CheckpointManager
+from flat_weights import WeightLayout
+from prefetcher import BatchPrefetcher
+from rate_limiter import RateLimiter
 
 import os
 import pickle
-import multiprocessing
 import copy
 import signal
 
@@ -32,29 +35,55 @@ class ReplayBuffer:
     """
 
     def __init__(self, obs_dim, act_dim, size):
-        self.obs1_buf = np.zeros([size, obs_dim], dtype=np.float32)
-        self.obs2_buf = np.zeros([size, obs_dim], dtype=np.float32)
+        # observations are stored once per step, obs2 of a transition is the next row of its segment
+        self.obs_buf = np.zeros([size, obs_dim], dtype=np.float32)
         self.acts_buf = np.zeros([size, act_dim], dtype=np.float32)
         self.rews_buf = np.zeros(size, dtype=np.float32)
         self.done_buf = np.zeros(size, dtype=np.float32)
+        # False for the last row of every segment, which only holds its final observation
+        self.valid_buf = np.zeros(size, dtype=bool)
         self.ptr, self.size, self.max_size = 0, 0, size
         self.steps, self.sample_times = 0, 0
 
     def store(self, obs, act, rew, next_obs, done):
-        self.obs1_buf[self.ptr] = obs
-        self.obs2_buf[self.ptr] = next_obs
-        self.acts_buf[self.ptr] = act
-        self.rews_buf[self.ptr] = rew
-        self.done_buf[self.ptr] = done
-        self.ptr = (self.ptr+1) % self.max_size
-        self.size = min(self.size+1, self.max_size)
-        self.steps += 1
+        self.store_many(np.array([obs, next_obs]), np.array([act]), np.array([rew]), np.array([done]))
+
+    def store_many(self, obs, acts, rews, done):
+        """
+        Store a trajectory segment of T transitions (T + 1 observations) of one episode,
+        with one slice assignment per array (two if the segment wraps around the ring).
+        """
+        n = len(obs)
+        self._ring_write(self.obs_buf, obs)
+        self._ring_write(self.acts_buf, np.concatenate([acts, np.zeros_like(acts[:1])]))
+        self._ring_write(self.rews_buf, np.append(rews, 0))
+        self._ring_write(self.done_buf, np.append(done, 0))
+        self._ring_write(self.valid_buf, np.arange(n) < n-1)
+        self.ptr = (self.ptr+n) % self.max_size
+        self.size = min(self.size+n, self.max_size)
+        self.steps += n-1
+
+    def _ring_write(self, buf, data):
+        first = min(len(data), self.max_size - self.ptr)
+        buf[self.ptr:self.ptr+first] = data[:first]
+        buf[:len(data)-first] = data[first:]
 
     def sample_batch(self, batch_size=128):
         idxs = np.random.randint(0, self.size, size=batch_size)
+        # redraw the segment tails, they have no transition. Tails are rare, so a few rounds almost always
+        # do, the rest is drawn from the valid rows directly
+        invalid = ~self.valid_buf[idxs]
+        for _ in range(10):
+            if not invalid.any():
+                break
+            idxs[invalid] = np.random.randint(0, self.size, size=invalid.sum())
+            invalid = ~self.valid_buf[idxs]
+        if invalid.any():
+            valid_rows = np.flatnonzero(self.valid_buf[:self.size])
+            idxs[invalid] = valid_rows[np.random.randint(0, len(valid_rows), size=invalid.sum())]
         self.sample_times += 1
-        return dict(obs1=self.obs1_buf[idxs],
-                    obs2=self.obs2_buf[idxs],
+        return dict(obs1=self.obs_buf[idxs],
+                    obs2=self.obs_buf[(idxs+1) % self.max_size],
                     acts=self.acts_buf[idxs],
                     rews=self.rews_buf[idxs],
                     done=self.done_buf[idxs])
@@ -66,6 +95,10 @@ class ReplayBuffer:
 @ray.remote
 class ParameterServer(object):
     def __init__(self, keys, values, weights_file=""):
+        # bumped by every push, callers pass the version they hold to pull_if_newer
+        self.version = 0
+        # ObjectRefs of what was ray.put for the current version, see _snapshot
+        self.snapshots, self.snapshot_version = {}, 0
         # These values will be mutated, so we must create a copy that is not
         # backed by the object store.
 
@@ -83,99 +116,134 @@ class ParameterServer(object):
             values = [value.copy() for value in values]
             self.weights = dict(zip(keys, values))
 
-    def push(self, keys, values):
-        values = [value.copy() for value in values]
-        for key, value in zip(keys, values):
-            self.weights[key] = value
-
-    def pull(self, keys):
-        return [self.weights[key] for key in keys]
+        # weights travel as one flat float32 vector laid out by self.layout,
+        # self.weights keeps views into it by name for saving
+        self.layout = WeightLayout(list(self.weights.keys()), [np.shape(v) for v in self.weights.values()])
+        self.flat = self.layout.flatten(self.weights)
+        self.weights = self.layout.unflatten(self.flat)
+
+    def get_layout(self):
+        return self.layout
+
+    def push(self, flat):
+        # a single copy, the views in self.weights follow
+        self.flat[:] = flat
+        self.version += 1
+
+    def pull(self):
+        return self.flat
+
+    def pull_if_newer(self, version):
+        # (version, ObjectRef of the flat weights), the ref is None if the caller's version is current
+        if version == self.version:
+            return self.version, None
+        return self.version, self._snapshot("flat", self.flat)
+
+    def _snapshot(self, name, value):
+        # each version is ray.put once and the callers only get its ObjectRef, so the weights reach
+        # the workers through the object store instead of one copy per call in this actor's replies
+        if self.snapshot_version != self.version:
+            self.snapshots, self.snapshot_version = {}, self.version
+        if name not in self.snapshots:
+            self.snapshots[name] = ray.put(value)
+        return self.snapshots[name]
 
     def get_weights(self):
         return self.weights
 
-    # save weights to disk
-    def save_weights(self, name):
-        with open(name + "weights.pickle", "wb") as pickle_out:
-            pickle.dump(self.weights, pickle_out)
-
-
-class Cache(object):
 
-    def __init__(self, replay_buffer):
-        # cache for training data and model weights
-        print('os.pid:', os.getpid())
-        self.replay_buffer = replay_buffer
-        self.q1 = multiprocessing.Queue(10)
-        self.q2 = multiprocessing.Queue(5)
-        self.p1 = multiprocessing.Process(target=self.ps_update, args=(self.q1, self.q2, self.replay_buffer))
-
-    def ps_update(self, q1, q2, replay_buffer):
-        print('os.pid of put_data():', os.getpid())
-
-        q1.put(copy.deepcopy(ray.get(replay_buffer.sample_batch.remote(opt.batch_size))))
-
-        while True:
-            q1.put(copy.deepcopy(ray.get(replay_buffer.sample_batch.remote(opt.batch_size))))
+class WeightPoller(object):
+    """
+    Non-blocking pull_if_newer for the rollout workers, the single ParameterServer counterpart of
+    WeightRefresher: request() sends the call, poll() checks it and then the snapshot it points to with
+    ray.wait(timeout=0) and loads the weights once they are local, so the env never waits for them.
+    step(), called once per env step, requests every interval steps and polls.
+    """
 
-            if not q2.empty():
-                keys, values = q2.get()
-                ps.push.remote(keys, values)
+    def __init__(self, ps, agent, layout, interval):
+        self.ps, self.agent, self.layout = ps, agent, layout
+        self.interval = interval
+        self.steps = 0
+        # version of the weights the agent holds
+        self.version, self.new_version = -1, -1
+        # ObjectRef in flight: the pull_if_newer reply, or the snapshot it returned if is_snapshot
+        self.pending, self.is_snapshot = None, False
 
-    def start(self):
-        self.p1.start()
-        self.p1.join(10)
+    def request(self):
+        if self.pending is None:
+            self.pending, self.is_snapshot = self.ps.pull_if_newer.remote(self.version), False
 
-    def end(self):
-        self.p1.terminate()
+    def step(self):
+        self.steps += 1
+        if self.interval > 0 and self.steps % self.interval == 0:
+            self.request()
+        self.poll()
+
+    def poll(self):
+        if self.pending is None or not ray.wait([self.pending], timeout=0)[0]:
+            return
+        result, self.pending = ray.get(self.pending), None
+        if self.is_snapshot:
+            self.agent.set_flat_weights(self.layout, result)
+            self.version = self.new_version
+        elif result[1] is not None:
+            self.new_version, self.pending, self.is_snapshot = result[0], result[1], True
+            self.poll()
 
 
 @ray.remote(num_gpus=1, max_calls=1)
-def worker_train(ps, replay_buffer, opt, learner_index):
+def worker_train(ps, replay_buffer, rate_limiter, opt, learner_index):
 
     agent = Learner(opt, job="learner")
-    keys = agent.get_weights()[0]
-    weights = ray.get(ps.pull.remote(keys))
-    agent.set_weights(keys, weights)
+    layout = ray.get(ps.get_layout.remote())
+    agent.set_flat_weights(layout, ray.get(ps.pull.remote()))
 
-    cache = Cache(replay_buffer)
-
-    cache.start()
+    prefetcher = BatchPrefetcher([replay_buffer], opt.prefetch_inflight, opt.prefetch_queue_size,
+                                 sample_args=(opt.batch_size,), rate_limiter=rate_limiter)
+    prefetcher.start()
 
     cnt = 1
     while True:
-        batch = cache.q1.get()
+        batch = prefetcher.get()
         agent.train(batch)
         if cnt % 300 == 0:
-            # print('q1.qsize():', q1.qsize(), 'q2.qsize():', q2.qsize())
-            cache.q2.put(agent.get_weights())
+            ps.push.remote(agent.get_flat_weights(layout))
             # keys, values = agent.get_weights()
             # ps.push.remote(copy.deepcopy(keys), copy.deepcopy(values))
         cnt += 1
 
 
 @ray.remote
-def worker_rollout(ps, replay_buffer, opt, worker_index):
+def worker_rollout(ps, replay_buffer, rate_limiter, opt, worker_index):
 
     # env = gym.make(opt.env_name)
 
     env = Wrapper(gym.make(opt.env_name), opt.obs_noise, opt.act_noise, opt.reward_scale, 3)
 
     agent = Actor(opt, job="worker")
-    keys = agent.get_weights()[0]
+    poller = WeightPoller(ps, agent, ray.get(ps.get_layout.remote()), opt.weights_refresh_steps)
 
     o, r, d, ep_ret, ep_len = env.reset(), 0, False, 0, 0
 
     # epochs = opt.total_epochs // opt.num_workers
     total_steps = opt.steps_per_epoch * opt.total_epochs
 
-    weights = ray.get(ps.pull.remote(keys))
-    agent.set_weights(keys, weights)
+    # the first weights are waited for
+    poller.request()
+    while poller.pending is not None:
+        ray.wait([poller.pending])
+        poller.poll()
+
+    # transitions waiting for the next store_many
+    chunk = []
 
     # TODO opt.start_steps
     # for t in range(total_steps):
     t = 0
     while True:
+        # swap in newer weights once they have arrived, never waits for them
+        poller.step()
+
         if t > opt.start_steps:
             a = agent.get_action(o)
         else:
@@ -191,8 +259,15 @@ def worker_rollout(ps, replay_buffer, opt, worker_index):
         # that isn't based on the agent's state)
         d = False if ep_len == opt.max_ep_len else d
 
-        # Store experience to replay buffer
-        replay_buffer.store.remote(o, a, r, o2, d)
+        # Store experience to replay buffer, opt.store_chunk_size transitions per call.
+        # A chunk never crosses an episode end, so it goes in as one trajectory segment.
+        chunk.append((o, a, r, d))
+        if len(chunk) >= opt.store_chunk_size or d or (ep_len == opt.max_ep_len):
+            obs, acts, rews, done = [np.array(x, dtype=np.float32) for x in zip(*chunk)]
+            # wait here while the actors are too far ahead of the learners
+            ray.get(rate_limiter.await_insert.remote(len(chunk)))
+            replay_buffer.store_many.remote(np.append(obs, [o2], axis=0), acts, rews, done)
+            chunk = []
 
         # Super critical, easy to overlook step: make sure to update
         # most recent observation!
@@ -200,15 +275,8 @@ def worker_rollout(ps, replay_buffer, opt, worker_index):
 
         # End of episode. Training (ep_len times).
         if d or (ep_len == opt.max_ep_len):
-            sample_times, steps, _ = ray.get(replay_buffer.get_counts.remote())
-
-            while sample_times > 0 and steps / sample_times > opt.a_l_ratio:
-                sample_times, steps, _ = ray.get(replay_buffer.get_counts.remote())
-                time.sleep(0.1)
-
-            # update parameters every episode
-            weights = ray.get(ps.pull.remote(keys))
-            agent.set_weights(keys, weights)
+            # update parameters every episode, the next steps pick them up
+            poller.request()
 
             o, r, d, ep_ret, ep_len = env.reset(), 0, False, 0, 0
 
@@ -218,7 +286,10 @@ def worker_test(ps, replay_buffer, opt):
 
     agent = Actor(opt, job="main")
 
-    keys, weights = agent.get_weights()
+    layout = ray.get(ps.get_layout.remote())
+    # version of the weights this worker holds
+    weights_version = -1
+    checkpoints = CheckpointManager(opt.save_dir + "/checkpoint", opt.keep_last_checkpoints, opt.keep_best_checkpoints)
 
     time0 = time1 = time.time()
     sample_times1, steps, size = ray.get(replay_buffer.get_counts.remote())
@@ -227,8 +298,10 @@ def worker_test(ps, replay_buffer, opt):
     env = gym.make(opt.env_name)
 
     while True:
-        weights = ray.get(ps.pull.remote(keys))
-        agent.set_weights(keys, weights)
+        weights_version, snapshot = ray.get(ps.pull_if_newer.remote(weights_version))
+        if snapshot is not None:
+            flat = ray.get(snapshot)
+            agent.set_flat_weights(layout, flat)
 
         ep_ret = agent.test(env, replay_buffer)
         sample_times2, steps, size = ray.get(replay_buffer.get_counts.remote())
@@ -237,7 +310,8 @@ def worker_test(ps, replay_buffer, opt):
         print('update frequency:', (sample_times2-sample_times1)/(time2-time1), 'total time:', time2 - time0)
 
         if ep_ret > max_ret:
-            ps.save_weights.remote()
+            # written in the background, the weights under test are copied first
+            checkpoints.save(layout.unflatten(flat), sample_times2, ep_ret)
             print("****** weights saved! ******")
             max_ret = ep_ret
 
@@ -267,13 +341,15 @@ if __name__ == '__main__':
         ps = ParameterServer.remote(all_keys, all_values)
 
     replay_buffer = ReplayBuffer.remote(obs_dim=opt.obs_dim, act_dim=opt.act_dim, size=opt.replay_size)
+    # a_l_ratio is enforced by blocking the stores and the learners' sampling
+    rate_limiter = ray.remote(RateLimiter).remote(1.0 / opt.a_l_ratio, opt.start_steps, opt.rate_limit_error)
 
     # Start some training tasks.
-    task_rollout = [worker_rollout.remote(ps, replay_buffer, opt, i) for i in range(FLAGS.num_workers)]
+    task_rollout = [worker_rollout.remote(ps, replay_buffer, rate_limiter, opt, i) for i in range(FLAGS.num_workers)]
 
     time.sleep(5)
 
-    task_train = [worker_train.remote(ps, replay_buffer, opt, i) for i in range(FLAGS.num_learners)]
+    task_train = [worker_train.remote(ps, replay_buffer, rate_limiter, opt, i) for i in range(FLAGS.num_learners)]
 
     task_test = worker_test.remote(ps, replay_buffer, opt)
 
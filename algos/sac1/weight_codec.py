@@ -0,0 +1,75 @@
+import zlib
+
+import numpy as np
+
+
+def transport_layout(layout, policy_scope, fp16):
+    """
+    Layout of the weights rollout workers pull: all of them, or with fp16 only the policy variables,
+    which the ParameterServer puts at the front of its layout.
+    """
+    if not fp16:
+        return layout
+    n = sum(policy_scope in key for key in layout.keys)
+    assert all(policy_scope in key for key in layout.keys[:n]), "policy variables must lead the layout"
+    return layout.head(n)
+
+
+class WeightEncoder(object):
+    """
+    ParameterServer side of the weight transport to rollout workers.
+
+    With fp16 the weights of the transport layout are cast to float16. With keyframe_interval > 0 every
+    keyframe_interval-th version becomes a keyframe and the versions in between are sent as the bitwise
+    XOR against the last keyframe, zlib-compressed: the sign, exponent and leading mantissa bits of
+    weights that moved little since the keyframe cancel out and compress away. Workers that don't hold
+    the current keyframe get it in full. Each version is encoded once, whatever the number of workers.
+    """
+
+    def __init__(self, layout, fp16, keyframe_interval):
+        self.size = layout.size
+        self.dtype, self.bits = (np.float16, np.uint16) if fp16 else (np.float32, np.uint32)
+        self.keyframe_interval = keyframe_interval
+        self.keyframe, self.keyframe_version = None, -1
+        self.delta, self.version = None, -1
+
+    def encode(self, flat, version, keyframe_version):
+        """
+        Payload taking a worker that holds keyframe keyframe_version to this version of flat:
+        (keyframe version, whether data is the keyframe itself, data).
+        """
+        if version != self.version:
+            values = flat[:self.size].astype(self.dtype)
+            if self.keyframe is None or self.keyframe_interval <= 0 or \
+                    version - self.keyframe_version >= self.keyframe_interval:
+                self.keyframe, self.keyframe_version = values, version
+                self.delta = None
+            else:
+                self.delta = zlib.compress(np.bitwise_xor(values.view(self.bits), self.keyframe.view(self.bits)), 1)
+            self.version = version
+
+        if self.delta is None or keyframe_version != self.keyframe_version:
+            return self.keyframe_version, True, self.keyframe
+        return self.keyframe_version, False, self.delta
+
+
+class WeightDecoder(object):
+    """
+    Rollout worker side of WeightEncoder, decode() gives the flat float32 weights of self.layout.
+    """
+
+    def __init__(self, layout, fp16):
+        self.layout = layout
+        self.dtype, self.bits = (np.float16, np.uint16) if fp16 else (np.float32, np.uint32)
+        self.keyframe, self.keyframe_version = None, -1
+
+    def decode(self, payload):
+        keyframe_version, is_keyframe, data = payload
+        if is_keyframe:
+            # a copy, so the object store can free the payload
+            self.keyframe, self.keyframe_version = data.copy(), keyframe_version
+            values = self.keyframe
+        else:
+            bits = np.frombuffer(zlib.decompress(data), dtype=self.bits)
+            values = np.bitwise_xor(bits, self.keyframe.view(self.bits)).view(self.dtype)
+        return values.astype(np.float32)
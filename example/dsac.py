@@ -18,28 +18,54 @@ class ReplayBuffer:
     """
 
     def __init__(self, obs_dim, act_dim, size):
-        self.obs1_buf = np.zeros([size, obs_dim], dtype=np.float32)
-        self.obs2_buf = np.zeros([size, obs_dim], dtype=np.float32)
+        # observations are stored once per step, obs2 of a transition is the next row of its segment
+        self.obs_buf = np.zeros([size, obs_dim], dtype=np.float32)
         self.acts_buf = np.zeros([size, act_dim], dtype=np.float32)
         self.rews_buf = np.zeros(size, dtype=np.float32)
         self.done_buf = np.zeros(size, dtype=np.float32)
+        # False for the last row of every segment, which only holds its final observation
+        self.valid_buf = np.zeros(size, dtype=bool)
         self.ptr, self.size, self.max_size = 0, 0, size
         self.rollout_steps = 0
 
     def store(self, obs, act, rew, next_obs, done):
-        self.obs1_buf[self.ptr] = obs
-        self.obs2_buf[self.ptr] = next_obs
-        self.acts_buf[self.ptr] = act
-        self.rews_buf[self.ptr] = rew
-        self.done_buf[self.ptr] = done
-        self.ptr = (self.ptr + 1) % self.max_size
-        self.size = min(self.size + 1, self.max_size)
-        self.rollout_steps += 1
+        self.store_many(np.array([obs, next_obs]), np.array([act]), np.array([rew]), np.array([done]))
+
+    def store_many(self, obs, acts, rews, done):
+        """
+        Store a trajectory segment of T transitions (T + 1 observations) of one episode,
+        with one slice assignment per array (two if the segment wraps around the ring).
+        """
+        n = len(obs)
+        self._ring_write(self.obs_buf, obs)
+        self._ring_write(self.acts_buf, np.concatenate([acts, np.zeros_like(acts[:1])]))
+        self._ring_write(self.rews_buf, np.append(rews, 0))
+        self._ring_write(self.done_buf, np.append(done, 0))
+        self._ring_write(self.valid_buf, np.arange(n) < n - 1)
+        self.ptr = (self.ptr + n) % self.max_size
+        self.size = min(self.size + n, self.max_size)
+        self.rollout_steps += n - 1
+
+    def _ring_write(self, buf, data):
+        first = min(len(data), self.max_size - self.ptr)
+        buf[self.ptr:self.ptr + first] = data[:first]
+        buf[:len(data) - first] = data[first:]
 
     def sample_batch(self, batch_size=32):
         idxs = np.random.randint(0, self.size, size=batch_size)
-        return dict(obs1=self.obs1_buf[idxs],
-                    obs2=self.obs2_buf[idxs],
+        # redraw the segment tails, they have no transition. Tails are rare, so a few rounds almost always
+        # do, the rest is drawn from the valid rows directly
+        invalid = ~self.valid_buf[idxs]
+        for _ in range(10):
+            if not invalid.any():
+                break
+            idxs[invalid] = np.random.randint(0, self.size, size=invalid.sum())
+            invalid = ~self.valid_buf[idxs]
+        if invalid.any():
+            valid_rows = np.flatnonzero(self.valid_buf[:self.size])
+            idxs[invalid] = valid_rows[np.random.randint(0, len(valid_rows), size=invalid.sum())]
+        return dict(obs1=self.obs_buf[idxs],
+                    obs2=self.obs_buf[(idxs + 1) % self.max_size],
                     acts=self.acts_buf[idxs],
                     rews=self.rews_buf[idxs],
                     done=self.done_buf[idxs])
@@ -51,6 +77,8 @@ class ReplayBuffer:
 @ray.remote
 class ParameterServer(object):
     def __init__(self, keys, values):
+        # bumped by every push, callers pass the version they hold to pull_if_newer
+        self.version = 0
         # These values will be mutated, so we must create a copy that is not
         # backed by the object store.
         values = [value.copy() for value in values]
@@ -60,10 +88,17 @@ class ParameterServer(object):
         values = [value.copy() for value in values]
         for key, value in zip(keys, values):
             self.weights[key] = value
+        self.version += 1
 
     def pull(self, keys):
         return [self.weights[key] for key in keys]
 
+    def pull_if_newer(self, keys, version):
+        # (version, weights), weights is None if the caller's version is current
+        if version == self.version:
+            return self.version, None
+        return self.version, self.pull(keys)
+
     def get_weights(self):
         return self.weights
 
@@ -81,9 +116,15 @@ def worker_rollout(ps, replay_buffer, args):
 
     agent = Model(args)
     keys = agent.get_weights()[0]
+    # version of the weights this worker holds
+    weights_version = -1
 
-    weights = ray.get(ps.pull.remote(keys))
-    agent.set_weights(keys, weights)
+    weights_version, weights = ray.get(ps.pull_if_newer.remote(keys, weights_version))
+    if weights is not None:
+        agent.set_weights(keys, weights)
+
+    # transitions of the current episode waiting for the next store_many
+    chunk = []
 
     # Main loop: collect experience in env and update/log each epoch
     for t in range(total_steps):
@@ -108,8 +149,13 @@ def worker_rollout(ps, replay_buffer, args):
         # that isn't based on the agent's state)
         d = False if ep_len == args.max_ep_len else d
 
-        # Store experience to replay buffer
-        replay_buffer.store.remote(o, a, r, o2, d)
+        # Store experience to replay buffer, args.store_chunk_size transitions per call.
+        # A chunk never crosses an episode end, so it goes in as one trajectory segment.
+        chunk.append((o, a, r, d))
+        if len(chunk) >= args.store_chunk_size or d or (ep_len == args.max_ep_len):
+            obs, acts, rews, done = [np.array(x, dtype=np.float32) for x in zip(*chunk)]
+            replay_buffer.store_many.remote(np.append(obs, [o2], axis=0), acts, rews, done)
+            chunk = []
 
         # Super critical, easy to overlook step: make sure to update
         # most recent observation!
@@ -126,8 +172,9 @@ def worker_rollout(ps, replay_buffer, args):
             # logger.store(EpRet=ep_ret, EpLen=ep_len)
             o, r, d, ep_ret, ep_len = env.reset(), 0, False, 0, 0
 
-            weights = ray.get(ps.pull.remote(keys))
-            agent.set_weights(keys, weights)
+            weights_version, weights = ray.get(ps.pull_if_newer.remote(keys, weights_version))
+            if weights is not None:
+                agent.set_weights(keys, weights)
 
 
 @ray.remote(num_gpus=1, max_calls=1)
@@ -163,9 +210,12 @@ def worker_test(ps, start_time):
 
     agent = Model(args)
     keys = agent.get_weights()[0]
+    # version of the weights this worker holds
+    weights_version = -1
 
-    weights = ray.get(ps.pull.remote(keys))
-    agent.set_weights(keys, weights)
+    weights_version, weights = ray.get(ps.pull_if_newer.remote(keys, weights_version))
+    if weights is not None:
+        agent.set_weights(keys, weights)
     test_env = gym.make(args.env)
     while True:
         ave_ret = agent.test_agent(test_env, args)
@@ -173,8 +223,9 @@ def worker_test(ps, start_time):
         logger.log_tabular('AverageTestEpRet', ave_ret)
         logger.log_tabular('Time', time.time() - start_time)
         logger.dump_tabular()
-        weights = ray.get(ps.pull.remote(keys))
-        agent.set_weights(keys, weights)
+        weights_version, weights = ray.get(ps.pull_if_newer.remote(keys, weights_version))
+        if weights is not None:
+            agent.set_weights(keys, weights)
 
 
 if __name__ == '__main__':
@@ -204,6 +255,7 @@ if __name__ == '__main__':
     args.max_ep_len = 1000
     args.logger_kwargs = dict()
     args.save_freq = 1
+    args.store_chunk_size = 64
     args.ac_kwargs = dict(hidden_sizes=[args.hid] * args.l)
 
     env = gym.make(args.env)